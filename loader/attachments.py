@@ -4,15 +4,17 @@ import os
 import hashlib
 import csv
 from sql import SqlDatabase, NoResult
+from storage import get_store
+from migrations import migrate
 
-def add_attachment(sql, asset_id, name, data):
+def add_attachment(sql, store, asset_id, name, data):
     h = hashlib.md5(data).hexdigest()
     try:
         attachment_id = sql.selectSingle('SELECT attachment_id FROM attachment WHERE hash=:h', h=h)
         print "Duplicate:", name
     except NoResult:
         print "New file:", name
-        attachment_id = sql.insert('INSERT INTO attachment VALUES (NULL, :name, :data, :h)', name=name, data=buffer(data), h=h)
+        attachment_id = store.add(sql, name, None, data)
     sql.insert('INSERT INTO attachment_asset_pivot VALUES (NULL, :attachment_id, :asset_id)', attachment_id=attachment_id, asset_id=asset_id)
 
 
@@ -22,6 +24,8 @@ if __name__ == '__main__':
         sys.exit(1)
 
     db = SqlDatabase(sys.argv[4])
+    migrate(db) # attachments need the size column (migration 3)
+    store = get_store()
 
     with db.cursor() as sql:
         sql.delete('DELETE FROM attachment')
@@ -59,5 +63,5 @@ if __name__ == '__main__':
             for filename in os.listdir(asset_path):
                 with open(os.path.join(asset_path, filename)) as f:
                     data = f.read()
-                add_attachment(sql, new_id, filename, data)
+                add_attachment(sql, store, new_id, filename, data)
 
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+""" Benchmark the xjoin endpoints, comparing the payload size and latency of the original output
+    (an array of {"asset_id": id} objects) with the flat asset id array output of the /ids variants.
+
+    Usage: bench_xjoin.py [xjoin URL] [runs]
+"""
+import sys
+from time import time
+import requests
+
+QUERIES = [
+    ('out', '/booking', {'out': ''}),
+    ('due out', '/booking', {'due': 'out'}),
+    ('overdue', '/booking', {'due': 'in'}),
+    ('unavailable', '/booking', {'unavailable': '2017-01-01'})
+]
+
+def bench(session, url, params, runs):
+    """ Return (payload bytes, mean ms, max ms) for GETting the URL runs times.
+        The xjoin cache means all but the first run should be hits.
+    """
+    times = []
+    size = 0
+    for _ in xrange(runs):
+        start = time()
+        r = session.get(url, params=params)
+        r.raise_for_status()
+        size = len(r.content)
+        times.append((time() - start) * 1000)
+    return size, sum(times) / len(times), max(times)
+
+
+if __name__ == '__main__':
+    base_url = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:8081'
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    session = requests.Session()
+    print "{0:12} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format('query', 'bytes', 'mean ms', 'max ms', 'ids bytes', 'mean ms', 'max ms')
+    for name, path, params in QUERIES:
+        results = bench(session, base_url + path, params, runs) + bench(session, base_url + path + '/ids', params, runs)
+        print "{0:12} {1:10} {2:10.2f} {3:10.2f} {4:10} {5:10.2f} {6:10.2f}".format(name, *results)
@@ -0,0 +1,96 @@
+""" Per-process result caches. ResultCache is validated by version counters (see migrations.py)
+    rather than by expiry, so that a stale result is never returned. ExpiringCache is not.
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+class ResultCache(object):
+    """ Thread safe LRU cache of up to size results. Each result is stored with the version
+        (any comparable value) it was computed at, and is only returned for that version.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, version):
+        """ Return the cached result for the key at the given version, or None.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] == version:
+                self.entries[key] = entry # now most recently used
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, value):
+        """ Cache the result for the key at the given version.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get(self, key, version, compute):
+        """ Return the cached result for the key at the given version, or else the result of
+            calling compute(), which is cached. Concurrent misses may both compute the result.
+        """
+        value = self.lookup(key, version)
+        if value is None:
+            value = compute()
+            self.put(key, version, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = float(self.hits) / lookups if lookups > 0 else None
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate, 'entries': len(self.entries), 'size': self.size}
+
+
+class ExpiringCache(object):
+    """ Thread safe cache whose entries expire ttl seconds after they are put, for results
+        that may be briefly stale (across processes) but are invalidated locally when changed.
+        Expired entries are only removed when looked up, so keys should come from a small set.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = Lock()
+        self.clock = time
+
+    def get(self, key):
+        """ Return the cached value for the key, or None if missing or expired.
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        now = self.clock()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
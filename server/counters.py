@@ -0,0 +1,84 @@
+#!/usr/bin/python
+""" Counter tables maintained incrementally by triggers (see migrations.py), so that hot
+    aggregates are indexed lookups rather than scans of the booking table.
+
+    Each counter is checked against the aggregate query it replaces, and can be rebuilt
+    from it should it ever drift (for example, after bulk edits with the triggers dropped).
+
+    Usage: counters.py <database> [rebuild | refresh]
+"""
+import sys
+from sql import SqlDatabase
+from migrations import USER_SUMMARY_SQL
+
+# table: (key and count columns compared, aggregate query giving the rows the table should hold)
+COUNTERS = {
+    'project_booking_count': (['project', 'n'], "SELECT project, COUNT(*) AS n FROM booking WHERE project IS NOT NULL GROUP BY project"),
+    'user_booking_summary': (['user_id', 'booked', 'out', 'overdue'], USER_SUMMARY_SQL.format("1"))
+}
+
+# summary rows, recomputing those computed before today (whose date dependent counts may have changed)
+CURRENT_USER_SUMMARY_SQL = """
+  SELECT * FROM user_booking_summary WHERE as_of >= date('now')
+   UNION ALL
+  {0}
+""".format(USER_SUMMARY_SQL.format("user.user_id IN (SELECT user_id FROM user_booking_summary WHERE as_of < date('now'))"))
+
+REFRESH_USER_SUMMARY_SQL = "INSERT OR REPLACE INTO user_booking_summary {0}".format(USER_SUMMARY_SQL.format("user.user_id IN (SELECT user_id FROM user_booking_summary WHERE as_of < date('now'))"))
+
+def refresh_user_summary(sql):
+    """ Store the recomputed summary rows for users whose rows were computed before today, so
+        that reads need not recompute them. Run daily.
+    """
+    sql.update(REFRESH_USER_SUMMARY_SQL)
+
+def _counts(sql, columns, stmt):
+    """ Return a dict from key to counts for the rows of the statement, omitting all zero counts.
+    """
+    rows = sql.selectAll("SELECT {0} FROM ({1})".format(', '.join(columns), stmt))
+    return dict((row[0], tuple(row[1:])) for row in rows if any(row[1:]))
+
+def verify(db, names=None):
+    """ Compare the named counter tables (by default, all) against their aggregates, ignoring
+        zero counts. Returns a list of (name, key, stored counts, actual counts) for each mismatch.
+    """
+    mismatches = []
+    with db.cursor() as sql:
+        for name in sorted(names or COUNTERS.keys()):
+            columns, aggregate = COUNTERS[name]
+            stored = _counts(sql, columns, CURRENT_USER_SUMMARY_SQL if name == 'user_booking_summary' else "SELECT * FROM {0}".format(name))
+            actual = _counts(sql, columns, aggregate)
+            zero = (0,) * (len(columns) - 1)
+            for key in sorted(set(stored.keys()) | set(actual.keys())):
+                if stored.get(key, zero) != actual.get(key, zero):
+                    mismatches.append((name, key, stored.get(key, zero), actual.get(key, zero)))
+    return mismatches
+
+def rebuild(db, names=None):
+    """ Rebuild the named counter tables (by default, all) from their aggregates, in a single
+        transaction.
+    """
+    with db.cursor() as sql:
+        for name in sorted(names or COUNTERS.keys()):
+            sql.delete("DELETE FROM {0}".format(name))
+            sql.insert("INSERT INTO {0} {1}".format(name, COUNTERS[name][1]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3] or (len(sys.argv) == 3 and sys.argv[2] not in ['rebuild', 'refresh']):
+        print >>sys.stderr, "Usage: {0} <database> [rebuild | refresh]".format(sys.argv[0])
+        sys.exit(1)
+
+    db = SqlDatabase(sys.argv[1])
+    if len(sys.argv) == 3 and sys.argv[2] == 'refresh':
+        with db.cursor() as sql:
+            refresh_user_summary(sql)
+        sys.exit(0)
+    mismatches = verify(db)
+    for name, key, stored, actual in mismatches:
+        print >>sys.stderr, "{0}: {1} has counts {2}, expected {3}".format(name, key, stored, actual)
+    if len(sys.argv) == 3:
+        rebuild(db)
+        mismatches = verify(db)
+        print "Rebuilt counters,", len(mismatches), "mismatches remain"
+    sys.exit(1 if len(mismatches) > 0 else 0)
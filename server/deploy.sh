@@ -3,4 +3,4 @@ if [ "" = "$1" ]; then
   echo "e.g. $0 tom@bart.ofcom.net"
   exit 1
 fi
-scp import_tprs.py config.py.example logger.py notifications.py solr.py server.py sql.py sql_app.py user_app.py xjoin.py $1:/usr/lib/badass/server
+scp import_tprs.py cache.py config.py.example counters.py enums.py jobs.py logger.py migrations.py notifications.py solr.py server.py sessions.py sql.py sql_app.py storage.py usage.py user_app.py xjoin.py $1:/usr/lib/badass/server
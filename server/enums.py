@@ -0,0 +1,60 @@
+""" Per-process cache of the enumerations and projects held in the SQL database.
+
+    The 'version' table holds counters that SQL triggers bump whenever the enum, enum_entry
+    or project tables change (whatever the process or script making the change), so checking
+    whether the cache is stale costs one small query.
+"""
+from threading import Lock
+
+VERSIONS_SQL = """
+  SELECT name, version
+    FROM version
+   WHERE name IN ('enum', 'project')
+ORDER BY name
+"""
+
+ENUMS_SQL = """
+  SELECT field, value, label, `order`
+    FROM enum LEFT JOIN enum_entry ON enum.enum_id=enum_entry.enum_id
+"""
+
+PROJECTS_SQL = """
+  SELECT *
+    FROM project
+"""
+
+def load_enums(sql):
+    """ Load all enumerations with a single query. Returns a dictionary from field to
+        a list of enum entry dictionaries (with keys value, label and order).
+    """
+    enums = {}
+    for field, value, label, order in sql.selectAll(ENUMS_SQL):
+        entries = enums.setdefault(field, [])
+        if value is not None:
+            entries.append({'value': value, 'label': label, 'order': order})
+    return enums
+
+
+class EnumRegistry(object):
+    """ Cache of all enumerations and projects, reloaded when the version counters change.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.versions = None
+        self.enums = None
+        self.projects = None
+        self.etag = None
+
+    def load(self, sql):
+        """ Return (enums, projects, etag), reloading from the database only if it has
+            changed since the last call. The returned values must not be modified.
+        """
+        # read the versions before the data, so a concurrent change is picked up next time
+        versions = tuple(sql.selectAll(VERSIONS_SQL))
+        with self.lock:
+            if versions != self.versions:
+                self.enums = load_enums(sql)
+                self.projects = sql.selectAllDict(PROJECTS_SQL)
+                self.versions = versions
+                self.etag = '-'.join(str(version) for _, version in versions)
+            return self.enums, self.projects, self.etag
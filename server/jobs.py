@@ -0,0 +1,219 @@
+""" Background jobs, for admin operations too long to run in a request thread.
+
+    Jobs are recorded in the job table (see migrations.py) and run by a small thread pool in
+    the server process. A job's function is called with a Job handle and the job's parameters
+    as keyword arguments, and returns a JSON serialisable result. It reports progress through
+    the handle, which is also where a request to cancel the job takes effect.
+
+    Each server process has a runner. A job is run by whichever process starts it first, which is
+    recorded as the job's owner (host:pid). When a runner starts (with the server, or else when
+    first used), jobs left running by a process on this host which no longer exists are recorded
+    as interrupted, and queued jobs are resumed.
+"""
+import os
+import json
+import errno
+import socket
+import logging
+from time import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from sql import SqlDatabase, NoResult
+from config import JOB_THREADS, JOB_PROGRESS_SECS, DATABASE_TIMEOUT, DATABASE_RETRIES
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+JOB_COLUMNS = "job_id, kind, params, state, total, done, result, error, user_id, owner, submitted, started, finished"
+
+ADD_JOB_SQL = """
+  INSERT INTO job (kind, params, state, done, user_id, submitted)
+       VALUES (:kind, :params, 'queued', 0, :user_id, datetime('now'))
+"""
+
+START_JOB_SQL = "UPDATE job SET state='running', started=datetime('now'), owner=:owner WHERE job_id=:job_id AND state='queued'"
+
+PROGRESS_SQL = "UPDATE job SET done=:done, total=IFNULL(:total, total) WHERE job_id=:job_id"
+
+# records the progress last reported, which may not have been written yet
+FINISH_JOB_SQL = "UPDATE job SET state=:state, done=IFNULL(:done, done), result=:result, error=:error, finished=datetime('now') WHERE job_id=:job_id"
+
+# a queued job is cancelled at once, a running one when it next reports progress
+CANCEL_JOB_SQL = """
+  UPDATE job
+     SET cancel=1,
+         state=CASE WHEN state='queued' THEN 'cancelled' ELSE state END,
+         finished=CASE WHEN state='queued' THEN datetime('now') ELSE finished END
+   WHERE job_id=:job_id AND state IN ('queued', 'running')
+"""
+
+GET_JOB_SQL = "SELECT {0} FROM job WHERE job_id=:job_id".format(JOB_COLUMNS)
+
+JOBS_SQL = "SELECT {0} FROM job ORDER BY job_id DESC LIMIT :limit".format(JOB_COLUMNS)
+
+RUNNING_JOBS_SQL = "SELECT job_id, owner FROM job WHERE state='running'"
+
+INTERRUPTED_JOB_SQL = "UPDATE job SET state='failed', error='Interrupted by a server restart', finished=datetime('now') WHERE job_id=:job_id AND state='running'"
+
+QUEUED_JOBS_SQL = "SELECT job_id FROM job WHERE state='queued' ORDER BY job_id"
+
+class JobCancelled(Exception):
+    pass
+
+
+def _owner():
+    """ Return the owner recorded for jobs run by this process.
+    """
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+def _gone(owner):
+    """ Return whether the process which owned a job (None for a job from before owners were
+        recorded) is known to have gone. A process on another host can't be checked, so isn't.
+    """
+    if owner is None:
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def _job_dict(row):
+    """ Return the job dictionary for a row from the job table, decoding JSON columns.
+    """
+    job = dict(row)
+    for column in ['params', 'result']:
+        job[column] = json.loads(job[column]) if job[column] is not None else None
+    return job
+
+
+class Job(object):
+    """ Handle passed to a running job's function.
+    """
+    def __init__(self, db, job_id):
+        self.db = db # the job's own connection, for the job function to use too
+        self.job_id = job_id
+        self.reported = 0
+        self.done = None # last progress reported
+
+    def progress(self, done, total=None):
+        """ Record progress (done out of total, if known). Writes are throttled, except for the
+            last. Raises JobCancelled if the job has been cancelled.
+        """
+        self.done = done
+        now = time()
+        if now < self.reported + JOB_PROGRESS_SECS and done != total:
+            return
+        self.reported = now
+        with self.db.cursor() as sql:
+            sql.update(PROGRESS_SQL, job_id=self.job_id, done=done, total=total)
+        self.check()
+
+    def check(self):
+        """ Raise JobCancelled if the job has been cancelled.
+        """
+        with self.db.cursor() as sql:
+            if sql.selectSingle("SELECT cancel FROM job WHERE job_id=:job_id", job_id=self.job_id):
+                raise JobCancelled()
+
+
+class JobRunner(object):
+    """ Runs jobs of registered kinds on a thread pool.
+    """
+    def __init__(self, database, threads=JOB_THREADS, log=None):
+        self.database = database
+        self.threads = threads
+        self.log = log or logging.getLogger(__name__)
+        self.kinds = {}
+        self.pool = None
+        self.lock = Lock()
+
+    def _connect(self):
+        return SqlDatabase(self.database, timeout=DATABASE_TIMEOUT, retries=DATABASE_RETRIES)
+
+    def register(self, kind, func):
+        """ Register the function which runs jobs of the given kind.
+        """
+        self.kinds[kind] = func
+
+    def start(self):
+        """ Start the thread pool, if not already started: record jobs left running by processes
+            which have gone as interrupted, and resume queued jobs. Called when the runner is first
+            used, if not before.
+        """
+        with self.lock:
+            if self.pool is not None:
+                return
+            db = self._connect()
+            try:
+                with db.cursor() as sql:
+                    for job_id, owner in sql.selectAll(RUNNING_JOBS_SQL):
+                        if _gone(owner):
+                            sql.update(INTERRUPTED_JOB_SQL, job_id=job_id)
+                    queued = sql.selectAllSingle(QUEUED_JOBS_SQL)
+            finally:
+                db.close()
+            self.pool = ThreadPool(self.threads)
+        for job_id in queued:
+            self.pool.apply_async(self._run, (job_id,))
+
+    def submit(self, kind, params, user_id=None):
+        """ Queue a job of the given kind with a dictionary of parameters, returning the job id.
+            Raises KeyError for an unknown kind.
+        """
+        if kind not in self.kinds:
+            raise KeyError(kind)
+        self.start()
+        db = self._connect()
+        try:
+            with db.cursor() as sql:
+                job_id = sql.insert(ADD_JOB_SQL, kind=kind, params=json.dumps(params), user_id=user_id)
+        finally:
+            db.close()
+        self.pool.apply_async(self._run, (job_id,))
+        return job_id
+
+    def _run(self, job_id):
+        db = self._connect()
+        try:
+            with db.cursor() as sql:
+                if sql.update(START_JOB_SQL, job_id=job_id, owner=_owner()) == 0:
+                    return # cancelled while queued
+                kind, params = sql.selectOne("SELECT kind, params FROM job WHERE job_id=:job_id", job_id=job_id)
+            state, result, error = DONE, None, None
+            job = Job(db, job_id)
+            try:
+                result = json.dumps(self.kinds[kind](job, **json.loads(params)))
+            except JobCancelled:
+                state = CANCELLED
+            except Exception as e: # pylint: disable=broad-except
+                self.log.exception("Job %s (%s) failed", job_id, kind)
+                state, error = FAILED, str(e)
+            with db.cursor() as sql:
+                sql.update(FINISH_JOB_SQL, job_id=job_id, state=state, done=job.done, result=result, error=error)
+        finally:
+            db.close()
+
+    def get(self, sql, job_id):
+        """ Return the job dictionary for the given job id, or None.
+        """
+        self.start()
+        try:
+            return _job_dict(sql.selectOneDict(GET_JOB_SQL, job_id=job_id))
+        except NoResult:
+            return None
+
+    def list(self, sql, limit=100):
+        """ Return job dictionaries for the most recent jobs.
+        """
+        self.start()
+        return [_job_dict(row) for row in sql.selectAllDict(JOBS_SQL, limit=limit)]
+
+    def cancel(self, sql, job_id):
+        """ Request cancellation of a queued or running job. Returns whether there was such a job.
+        """
+        self.start()
+        return sql.update(CANCEL_JOB_SQL, job_id=job_id) > 0
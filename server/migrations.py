@@ -0,0 +1,237 @@
+#!/usr/bin/python
+""" Versioned schema migrations for the SQL database.
+
+    The schema version is held in PRAGMA user_version: a database created by sql/create.sql
+    is at version 0, and applying MIGRATIONS[n] takes it to version n + 1. Migrations are only
+    ever appended to this list, never edited once deployed.
+
+    Usage: migrations.py <database> [check]
+"""
+import re
+import sys
+from sql import SqlDatabase
+
+# booking_rtree row for a booking row {0}. R*Tree coordinates are 32 bit floats, exact for whole
+# days since 1970; missing or bad dates give an unbounded interval. The R*Tree only ever narrows
+# the candidates, queries still apply the exact date predicates.
+BOOKING_RTREE_ROW = """{0}.booking_id, {0}.asset_id, {0}.asset_id,
+IFNULL(julianday({0}.due_out_date) - 2440587.5, -1e7),
+MAX(IFNULL(julianday({0}.due_out_date) - 2440587.5, -1e7), IFNULL(julianday(IFNULL({0}.in_date, {0}.due_in_date)) - 2440587.5, 1e7))"""
+
+# trigger statements maintaining project_booking_count (guarded against NULL projects, which are not counted)
+PROJECT_COUNT_INCREMENT = """INSERT OR IGNORE INTO project_booking_count SELECT NEW.project, 0 WHERE NEW.project IS NOT NULL;
+UPDATE project_booking_count SET n=n+1 WHERE project=NEW.project;"""
+PROJECT_COUNT_DECREMENT = "UPDATE project_booking_count SET n=n-1 WHERE project=OLD.project;"
+
+# per-user booking summary rows for the users matching a condition {0}: the number of assets 'booked' (the booking
+# lasts until after today - except for early returns - or the asset is still out), 'out' (taken out and not returned)
+# and 'overdue' (should have been returned by today, but hasn't been), as of today
+USER_SUMMARY_SQL = """SELECT user.user_id,
+COUNT(CASE WHEN IFNULL(in_date, due_in_date) >= date('now') OR (out_date IS NOT NULL AND in_date IS NULL) THEN 1 ELSE NULL END) AS booked,
+COUNT(CASE WHEN out_date IS NOT NULL AND in_date IS NULL THEN 1 ELSE NULL END) AS out,
+COUNT(CASE WHEN out_date IS NOT NULL AND in_date IS NULL AND due_in_date < date('now') THEN 1 ELSE NULL END) AS overdue,
+date('now') AS as_of
+FROM user LEFT JOIN booking ON booking.user_id=user.user_id
+WHERE {0}
+GROUP BY user.user_id"""
+
+MIGRATIONS = [
+    # 1: version counters, bumped by triggers whenever the named tables change, so that
+    # per-process caches (see enums.py) can cheaply check whether they are stale
+    [
+        "CREATE TABLE IF NOT EXISTS version(name VARCHAR(32) PRIMARY KEY, version INTEGER)",
+        "INSERT OR IGNORE INTO version VALUES ('enum', 0)",
+        "INSERT OR IGNORE INTO version VALUES ('project', 0)",
+        "CREATE TRIGGER IF NOT EXISTS enum_insert AFTER INSERT ON enum BEGIN UPDATE version SET version=version+1 WHERE name='enum'; END",
+        "CREATE TRIGGER IF NOT EXISTS enum_update AFTER UPDATE ON enum BEGIN UPDATE version SET version=version+1 WHERE name='enum'; END",
+        "CREATE TRIGGER IF NOT EXISTS enum_delete AFTER DELETE ON enum BEGIN UPDATE version SET version=version+1 WHERE name='enum'; END",
+        "CREATE TRIGGER IF NOT EXISTS enum_entry_insert AFTER INSERT ON enum_entry BEGIN UPDATE version SET version=version+1 WHERE name='enum'; END",
+        "CREATE TRIGGER IF NOT EXISTS enum_entry_update AFTER UPDATE ON enum_entry BEGIN UPDATE version SET version=version+1 WHERE name='enum'; END",
+        "CREATE TRIGGER IF NOT EXISTS enum_entry_delete AFTER DELETE ON enum_entry BEGIN UPDATE version SET version=version+1 WHERE name='enum'; END",
+        "CREATE TRIGGER IF NOT EXISTS project_insert AFTER INSERT ON project BEGIN UPDATE version SET version=version+1 WHERE name='project'; END",
+        "CREATE TRIGGER IF NOT EXISTS project_update AFTER UPDATE ON project BEGIN UPDATE version SET version=version+1 WHERE name='project'; END",
+        "CREATE TRIGGER IF NOT EXISTS project_delete AFTER DELETE ON project BEGIN UPDATE version SET version=version+1 WHERE name='project'; END"
+    ],
+    # 2: indexes for the clash checks, xjoin filters, booking tables, attachment and enum lookups
+    [
+        "CREATE INDEX booking_asset_index ON booking(asset_id, due_out_date, due_in_date, in_date, user_id)",
+        "CREATE INDEX booking_user_index ON booking(user_id, due_in_date)",
+        "CREATE INDEX booking_project_index ON booking(project, due_in_date)",
+        "CREATE INDEX booking_due_in_index ON booking(due_in_date)",
+        "CREATE INDEX booking_out_index ON booking(due_in_date, asset_id) WHERE out_date IS NOT NULL AND in_date IS NULL",
+        "CREATE INDEX attachment_hash_index ON attachment(hash)",
+        "CREATE INDEX attachment_folder_index ON attachment(folder_id)",
+        "CREATE INDEX attachment_asset_pivot_asset_index ON attachment_asset_pivot(asset_id, attachment_id)",
+        "CREATE INDEX attachment_asset_pivot_attachment_index ON attachment_asset_pivot(attachment_id)",
+        "CREATE INDEX enum_field_index ON enum(field)",
+        "CREATE INDEX enum_entry_value_index ON enum_entry(enum_id, value)",
+        "CREATE INDEX user_username_index ON user(username)",
+        "CREATE INDEX notification_role_pivot_notification_index ON notification_role_pivot(notification_id)",
+        "CREATE INDEX trigger_notification_index ON trigger(notification_id)",
+        "CREATE INDEX trigger_filter_trigger_index ON trigger_filter(trigger_id)"
+    ],
+    # 3: attachment size, so that the body need not be in the database (see storage.py)
+    [
+        "ALTER TABLE attachment ADD COLUMN size INTEGER",
+        "UPDATE attachment SET size=length(data)"
+    ],
+    # 4: R*Tree interval index over bookings (asset x [due out, in or due in] in days since 1970),
+    # kept in sync by triggers - see BOOKING_RTREE_ROW
+    [
+        "CREATE VIRTUAL TABLE booking_rtree USING rtree(booking_id, min_asset, max_asset, start, end)",
+        "INSERT INTO booking_rtree SELECT {0} FROM booking".format(BOOKING_RTREE_ROW.format('booking')),
+        "CREATE TRIGGER booking_rtree_insert AFTER INSERT ON booking BEGIN INSERT INTO booking_rtree VALUES ({0}); END".format(BOOKING_RTREE_ROW.format('NEW')),
+        "CREATE TRIGGER booking_rtree_update AFTER UPDATE OF booking_id, asset_id, due_out_date, due_in_date, in_date ON booking BEGIN DELETE FROM booking_rtree WHERE booking_id=OLD.booking_id; INSERT INTO booking_rtree VALUES ({0}); END".format(BOOKING_RTREE_ROW.format('NEW')),
+        "CREATE TRIGGER booking_rtree_delete AFTER DELETE ON booking BEGIN DELETE FROM booking_rtree WHERE booking_id=OLD.booking_id; END"
+    ],
+    # 5: booking version counter, for the xjoin result cache
+    [
+        "INSERT OR IGNORE INTO version VALUES ('booking', 0)",
+        "CREATE TRIGGER booking_insert AFTER INSERT ON booking BEGIN UPDATE version SET version=version+1 WHERE name='booking'; END",
+        "CREATE TRIGGER booking_update AFTER UPDATE ON booking BEGIN UPDATE version SET version=version+1 WHERE name='booking'; END",
+        "CREATE TRIGGER booking_delete AFTER DELETE ON booking BEGIN UPDATE version SET version=version+1 WHERE name='booking'; END"
+    ],
+    # 6: booking counts per project, kept up to date by triggers (see counters.py)
+    [
+        "CREATE TABLE project_booking_count(project INTEGER PRIMARY KEY, n INTEGER NOT NULL)",
+        "INSERT INTO project_booking_count SELECT project, COUNT(*) FROM booking WHERE project IS NOT NULL GROUP BY project",
+        "CREATE TRIGGER project_booking_count_insert AFTER INSERT ON booking WHEN NEW.project IS NOT NULL BEGIN {0} END".format(PROJECT_COUNT_INCREMENT),
+        "CREATE TRIGGER project_booking_count_update AFTER UPDATE OF project ON booking WHEN OLD.project IS NOT NEW.project BEGIN {0} {1} END".format(PROJECT_COUNT_DECREMENT, PROJECT_COUNT_INCREMENT),
+        "CREATE TRIGGER project_booking_count_delete AFTER DELETE ON booking WHEN OLD.project IS NOT NULL BEGIN {0} END".format(PROJECT_COUNT_DECREMENT)
+    ],
+    # 7: per-user booking summary, recomputed for the affected users by triggers, and for
+    # rows computed before today when read (see counters.py)
+    [
+        "CREATE TABLE user_booking_summary(user_id INTEGER PRIMARY KEY, booked INTEGER, out INTEGER, overdue INTEGER, as_of DATE)",
+        "INSERT INTO user_booking_summary {0}".format(USER_SUMMARY_SQL.format("1")),
+        "CREATE TRIGGER user_booking_summary_insert AFTER INSERT ON booking BEGIN INSERT OR REPLACE INTO user_booking_summary {0}; END".format(USER_SUMMARY_SQL.format("user.user_id=NEW.user_id")),
+        "CREATE TRIGGER user_booking_summary_update AFTER UPDATE OF user_id, due_in_date, out_date, in_date ON booking BEGIN INSERT OR REPLACE INTO user_booking_summary {0}; END".format(USER_SUMMARY_SQL.format("user.user_id IN (OLD.user_id, NEW.user_id)")),
+        "CREATE TRIGGER user_booking_summary_delete AFTER DELETE ON booking BEGIN INSERT OR REPLACE INTO user_booking_summary {0}; END".format(USER_SUMMARY_SQL.format("user.user_id=OLD.user_id"))
+    ],
+    # 8: logged in users, shared by the server processes (see sessions.py)
+    [
+        "CREATE TABLE session(user_id INTEGER PRIMARY KEY, expires REAL)"
+    ],
+    # 9: background jobs (see jobs.py)
+    [
+        "CREATE TABLE job(job_id INTEGER PRIMARY KEY, kind VARCHAR(32), params TEXT, state VARCHAR(16), total INTEGER, done INTEGER, result TEXT, error TEXT, cancel INTEGER NOT NULL DEFAULT 0, user_id INTEGER, submitted DATETIME, started DATETIME, finished DATETIME)",
+        "CREATE INDEX job_state_index ON job(state)"
+    ],
+    # 10: usage counts of enum values in SOLR asset fields, for the fields listed in
+    # enum_usage_field (see usage.py)
+    [
+        "CREATE TABLE enum_usage(field VARCHAR(32), value INTEGER, n INTEGER NOT NULL, PRIMARY KEY (field, value))",
+        "CREATE TABLE enum_usage_field(field VARCHAR(32) PRIMARY KEY, reconciled DATETIME)"
+    ],
+    # 11: drop a deleted user's booking summary, which the booking triggers (only ever summarising
+    # existing users) would otherwise leave in place
+    [
+        "DELETE FROM user_booking_summary WHERE user_id NOT IN (SELECT user_id FROM user)",
+        "CREATE TRIGGER user_booking_summary_user_delete AFTER DELETE ON user BEGIN DELETE FROM user_booking_summary WHERE user_id=OLD.user_id; END"
+    ],
+    # 12: the process running a job (host:pid), so that only jobs whose process has gone are
+    # taken to have been interrupted (see jobs.py)
+    [
+        "ALTER TABLE job ADD COLUMN owner VARCHAR(64)"
+    ]
+]
+
+# small tables which the hot queries may scan without an index (any others, including aliases, may not be)
+SMALL_TABLES = ['enum', 'user', 'project', 'project_booking_count', 'user_booking_summary', 'session', 'notification', 'attachment_folder', 'version']
+
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?!(?:\d+ )?CONSTANT ROW)(\w+)')
+PARAM_RE = re.compile(r':(\w+)')
+
+def schema_version(db):
+    """ Return the schema version of the database.
+    """
+    return db.db.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(db, migrations=MIGRATIONS):
+    """ Apply any outstanding migrations, each in its own transaction, then ANALYZE if anything
+        changed. Safe to run concurrently from several processes. Returns the number of
+        migrations applied.
+    """
+    conn = db.db
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None # manage transactions here - sqlite3 commits before DDL otherwise
+    applied = 0
+    try:
+        for version in xrange(schema_version(db), len(migrations)):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # re-check now we hold the write lock, in case another process got here first
+                if schema_version(db) == version:
+                    for stmt in migrations[version]:
+                        conn.execute(stmt)
+                    conn.execute("PRAGMA user_version={0}".format(version + 1))
+                    applied += 1
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        if applied > 0:
+            conn.execute("ANALYZE")
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+def hot_queries():
+    """ Return a list of (name, statement) for the frequently run queries that must use indexes.
+    """
+    import server, xjoin # pylint: disable=import-error
+    queries = [
+        ('check booking', server.CHECK_BOOKING_SQL),
+        ('check clash', server.CHECK_CLASH_SQL),
+        ('availability', server.AVAILABILITY_SQL.format('(:asset_id)')),
+        ('bulk clash', server.BULK_CLASH_SQL.format('(:booking_id)')),
+        ('check out', server.CHECK_OUT_SQL),
+        ('check in', server.CHECK_IN_SQL),
+        ('asset attachments', server.ASSET_ATTACHMENTS_SQL),
+        ('count attachment assets', server.COUNT_ASSETS_FOR_ATTACHMENT_SQL),
+        ('attachment by hash', "SELECT attachment_id, name FROM attachment WHERE hash=:hash"),
+        ('enum entry', "SELECT label FROM enum, enum_entry WHERE field=:field AND enum.enum_id=enum_entry.enum_id AND value=:value"),
+        ('xjoin out', xjoin.OUT_SQL),
+        ('xjoin due out', xjoin.DUE_OUT_SQL),
+        ('xjoin overdue', xjoin.OVERDUE_SQL),
+        ('xjoin unavailable', xjoin.UNAVAILABLE_SQL),
+        ('xjoin project', xjoin.FILTER_PROJECT_SQL),
+        ('xjoin user', xjoin.FILTER_USER_SQL),
+        ('project counts', server.PROJECT_COUNTS_SQL),
+        ('project usage', server.PROJECT_USAGE_SQL),
+        ('user booking summary', server.USER_BOOKING_SUMMARY_SQL)
+    ]
+    for table, column in [('booking', 'asset_id'), ('user', 'user_id'), ('booking', 'project')]:
+        for clause in [server.EXTANT_CLAUSE, server.RANGE_CLAUSE]:
+            queries.append(('bookings by {0}'.format(column), server.BOOKINGS_SQL.format(table, column, clause)))
+    return queries
+
+def check_query_plans(db, queries):
+    """ Use EXPLAIN QUERY PLAN to check that none of the given (name, statement) queries scans
+        a table, other than one of the SMALL_TABLES, without an index. Returns a list of (name, plan detail) for
+        each offending scan.
+    """
+    failures = []
+    for name, stmt in queries:
+        values = dict((param, None) for param in PARAM_RE.findall(stmt))
+        for row in db.db.execute("EXPLAIN QUERY PLAN {0}".format(stmt), values):
+            detail = row[-1]
+            match = SCAN_RE.match(detail)
+            if match is not None and match.group(1) not in SMALL_TABLES and 'INDEX' not in detail:
+                failures.append((name, detail))
+    return failures
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3] or (len(sys.argv) == 3 and sys.argv[2] != 'check'):
+        print >>sys.stderr, "Usage: {0} <database> [check]".format(sys.argv[0])
+        sys.exit(1)
+
+    db = SqlDatabase(sys.argv[1])
+    print "Schema version", schema_version(db)
+    print "Applied", migrate(db), "migrations"
+    if len(sys.argv) == 3:
+        failures = check_query_plans(db, hot_queries())
+        for name, detail in failures:
+            print >>sys.stderr, "Query '{0}' not using an index: {1}".format(name, detail)
+        sys.exit(1 if len(failures) > 0 else 0)
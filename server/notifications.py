@@ -10,12 +10,14 @@ import datetime
 import re
 import subprocess
 import logging
-from sql import SqlDatabase, NoResult
+from operator import eq, ne, lt, gt, le, ge
+from sql import SqlDatabase
 from solr import AssetIndex
+from enums import load_enums
 from config import DATABASE, SOLR_COLLECTION, MAIL_COMMAND, MAIL_FROM_SWITCH, MAIL_FROM_FORMAT, MAIL_FROM, MAIL_TO_FORMAT
 from logger import get_logger
 
-OPERATORS = ['==', '!=', '<', '>', '<=', '>='] # allowed filter operators
+OPERATORS = {'==': eq, '!=': ne, '<': lt, '>': gt, '<=': le, '>=': ge} # allowed filter operators
 COLUMN_FIELD = re.compile(r'^[a-zA-Z_]+$') # allowed column/field names
 
 debug = False
@@ -51,45 +53,144 @@ class Email(object):
         log.debug("%s\nStdout: %s\nStderr: %s", str(args), stdout, stderr)
 
 
+NOTIFICATIONS_SQL = """
+  SELECT *
+    FROM notification
+   WHERE :notification_id IS NULL OR notification_id=:notification_id
+ORDER BY notification_id
+"""
+
+ROLES_SQL = """
+  SELECT notification_id, role
+    FROM notification_role_pivot
+   WHERE :notification_id IS NULL OR notification_id=:notification_id
+"""
+
+TRIGGERS_SQL = """
+  SELECT *
+    FROM trigger
+   WHERE :notification_id IS NULL OR notification_id=:notification_id
+ORDER BY trigger_id
+"""
+
+FILTERS_SQL = """
+  SELECT trigger_filter.*
+    FROM trigger_filter, trigger
+   WHERE trigger_filter.trigger_id=trigger.trigger_id
+     AND (:notification_id IS NULL OR notification_id=:notification_id)
+ORDER BY filter_id
+"""
+
+RECIPIENTS_SQL = """
+  SELECT role, label, email
+    FROM user, enum, enum_entry
+   WHERE field='user'
+     AND enum.enum_id=enum_entry.enum_id
+     AND value=user.user_id
+"""
+
 BRACKETS_RE = re.compile(r'\[(.+?)\]|<(.+?)>')
 
-def _get_enumeration_value(sql, key, value):
+BAD_ENUM = "<bad key or no value>"
+
+def enum_labels(sql):
+    """ Return a dictionary from enum field to a dictionary from value to label, loaded
+        with one query.
+    """
+    return dict((field, dict((entry['value'], entry['label']) for entry in entries)) for field, entries in load_enums(sql).iteritems())
+
+def _enum_label(labels, key, value):
     try:
-        return sql.selectSingle("SELECT label FROM enum, enum_entry WHERE field=:field AND enum.enum_id=enum_entry.enum_id AND value=:value", field=key, value=value)
-    except NoResult:
-        return "<bad key or no value>"
-
-def _eval_line(sql, line, values, asset):
-    result = []
-    pos = 0
-    for match in BRACKETS_RE.finditer(line):
-        result.append(line[pos:match.start()])
-        for index, brackets, source in [(0, '[]', values), (1, '<>', asset)]:
-            if match.groups()[index] is not None:
-                key = match.groups()[index].lower()
-                enum = key[0] == ':'
-                if enum:
-                    key = key[1:]
-                if source is not None:
-                    value = source.get(key, '{0}BAD KEY: {1}{2}'.format(brackets[0], key, brackets[1]))
-                else:
-                    value = '{0}NOT AVAILABLE{1}'.format(brackets[0], brackets[1])
+        value = int(value) # enum_entry.value is an INTEGER column, but may be compared with a string
+    except (TypeError, ValueError):
+        pass
+    return labels.get(key, {}).get(value, BAD_ENUM)
+
+
+class Template(object):
+    """ A title or body template, parsed once. A template can refer to booking or user table
+        column values like [column] and asset field values like <field>, or to the enum label
+        for the value with [:column] or <:field>. In a report, lines starting with '*' are
+        repeated for each asset.
+    """
+    def __init__(self, template):
+        self.lines = []
+        self.fields = set() # asset fields referred to
+        for line in (template or '').split('\n'):
+            parts = self._parse(line)
+            star = len(line) > 0 and line[0] == '*'
+            self.lines.append(([parts[0][1:]] + parts[1:] if star else None, parts))
+
+    def _parse(self, line):
+        """ Split the line into a list of literal strings and placeholder tuples of
+            (source index, key, enum, bad key text, not available text).
+        """
+        parts = []
+        pos = 0
+        for match in BRACKETS_RE.finditer(line):
+            parts.append(line[pos:match.start()])
+            for index, brackets in [(0, '[]'), (1, '<>')]:
+                if match.groups()[index] is not None:
+                    key = match.groups()[index].lower()
+                    enum = key[0] == ':'
+                    if enum:
+                        key = key[1:]
+                    if index == 1:
+                        self.fields.add(key)
+                    bad_key = '{0}BAD KEY: {1}{2}'.format(brackets[0], key, brackets[1])
+                    parts.append((index, key, enum, bad_key, '{0}NOT AVAILABLE{1}'.format(*brackets)))
+            pos = match.end()
+        parts.append(line[pos:])
+        return parts
+
+    def _render_line(self, parts, labels, values, asset):
+        result = []
+        for part in parts:
+            if isinstance(part, tuple):
+                index, key, enum, bad_key, not_available = part
+                source = asset if index == 1 else values
+                value = source.get(key, bad_key) if source is not None else not_available
                 if enum:
-                    value = _get_enumeration_value(sql, key, value)
+                    value = _enum_label(labels, key, value)
                 result.append(value)
-        pos = match.end()
-    result.append(line[pos:])
-    return ''.join([str(x) for x in result])
-
-def _eval_template(sql, template, values, asset, assets):
-    lines = []
-    for line in template.split('\n'):
-        if assets is not None and len(line) > 0 and line[0] == '*':
-            for asset in assets:
-                lines.append(_eval_line(sql, line[1:], values, asset))
-        else:
-            lines.append(_eval_line(sql, line, values, asset))
-    return '\n'.join(lines)
+            else:
+                result.append(part)
+        return ''.join([str(x) for x in result])
+
+    def render(self, labels, values, asset, assets=None):
+        """ Render the template, with enum labels from a dictionary returned by enum_labels().
+        """
+        lines = []
+        for star_parts, parts in self.lines:
+            if assets is not None and star_parts is not None:
+                for item in assets:
+                    lines.append(self._render_line(star_parts, labels, values, item))
+            else:
+                lines.append(self._render_line(parts, labels, values, asset))
+        return '\n'.join(lines)
+
+
+class AssetCache(object):
+    """ Assets fetched from the index during a notifications run, so that each is fetched
+        at most once however many notifications and triggers refer to it.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.assets = {}
+
+    def fetch(self, asset_ids):
+        """ Fetch any of the given assets not already cached, in batches.
+        """
+        missing = set(asset_ids).difference(self.assets)
+        if len(missing) > 0:
+            found = self.index.get_many(missing)
+            for asset_id in missing:
+                self.assets[asset_id] = found.get(asset_id, None)
+
+    def get(self, asset_id):
+        """ Return a fetched asset, or None if it does not exist.
+        """
+        return self.assets.get(asset_id, None)
 
 
 class Filter(object):
@@ -102,16 +203,45 @@ class Filter(object):
         assert self.field is None or COLUMN_FIELD.match(self.field)
         assert operator in OPERATORS
 
+    def _value(self):
+        if self.value == 'now':
+            return datetime.datetime.now().isoformat()[:10]
+        if self.value == 'null':
+            return None
+        return self.value # must be an enum value
+
     def _apply(self, values, asset):
         test_value = values[self.column] if self.column is not None else asset.get(self.field, None)
+        return OPERATORS[self.operator](test_value, self._value())
+
+    def fq(self):
+        """ Return a SOLR filter query equivalent to applying the filter to assets, or None
+            for a booking column filter. Python 2 comparison semantics are kept: a missing
+            field is None, which is less than any value, and 'now' is a date string, so that
+            a date field value on today's date is greater than 'now'.
+        """
+        if self.field is None:
+            return None
+        f = self.field
+        missing = '(*:* -{0}:[* TO *])'.format(f)
+        value = self._value()
+        if value is None:
+            return {'==': '-{0}:[* TO *]', '!=': '{0}:[* TO *]', '<': '-*:*', '>': '{0}:[* TO *]', '<=': '-{0}:[* TO *]', '>=': '*:*'}[self.operator].format(f)
         if self.value == 'now':
-            value = datetime.datetime.now().isoformat()[:10]
-        elif self.value == 'null':
-            value = None
+            if self.operator in ['==', '!=']: # a date field value never equals a date string
+                return '-*:*' if self.operator == '==' else '*:*'
+            term, inclusive = '{0}T00:00:00Z'.format(value), False
         else:
-            # must be an enum value
-            value = self.value
-        return eval("test_value{0}value".format(self.operator))
+            term, inclusive = '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"')), True
+        if self.operator == '==':
+            return '{0}:{1}'.format(f, term)
+        if self.operator == '!=':
+            return '-{0}:{1}'.format(f, term)
+        if self.operator in ['<', '<=']:
+            end = ']' if self.operator == '<=' and inclusive else '}'
+            return '{0}:[* TO {1}{2} OR {3}'.format(f, term, end, missing)
+        start = '[' if self.operator == '>=' or not inclusive else '{'
+        return '{0}:{1}{2} TO *]'.format(f, start, term)
 
     def __repr__(self):
         return "<Filter: column='{0}' field='{1}' operator='{2}' value='{3}'>".format(self.column, self.field, self.operator, self.value)
@@ -125,35 +255,44 @@ class Trigger(object):
         assert self.column is None or COLUMN_FIELD.match(self.column)
         assert self.field is None or COLUMN_FIELD.match(self.field)
 
-    def _filter(self, values, asset):
-        """ Return whether the filters allow a trigger event.
+    def _filter(self, values, asset, pushed_down=False):
+        """ Return whether the filters allow a trigger event. If pushed_down is True, the
+            asset has come from a SOLR query using fq(), so only column filters are applied.
         """
         log.debug("Testing trigger filters against asset %s", asset['id'])
         for filter in self.filters:
+            if pushed_down and filter.field is not None:
+                continue
             if not filter._apply(values, asset):
                 return False
         return True
 
+    def fq(self):
+        """ Return a list of (name, value) SOLR parameters for the field filters.
+        """
+        return [('fq', filter.fq()) for filter in self.filters if filter.field is not None]
+
 class Notification(object):
     """ Class representing a notification specification.
     """
-    def __init__(self, roles, triggers, notification_id=None, name=None, title_template=None, body_template=None, every=None, offset=None, run=None, **_):
+    def __init__(self, roles, triggers, recipients=None, notification_id=None, name=None, title_template=None, body_template=None, every=None, offset=None, run=None, **_):
         self.id = notification_id
         self.name = name
-        self.title_template = title_template # title_template can refer to booking or user table column values like [column] and asset field values like <field>
-        self.body_template = body_template # as title_template
+        self.title_template = Template(title_template)
+        self.body_template = Template(body_template)
         self.roles = roles # the roles associated with this notification (all users with any of these roles are cc'd in the mail, if triggered)
+        self.recipients = recipients or [] # (name, email) of the users with those roles
         self.triggers = triggers
         self.every = every
         self.offset = int(offset) if offset is not None else None
         self.run = run
 
-    def _mail(self, sql, values, asset, assets=None):
-        title = _eval_template(sql, self.title_template, values, asset, assets)
-        body = _eval_template(sql, self.body_template, values, asset, assets)
+    def _mail(self, sql, labels, values, asset, assets=None):
+        title = self.title_template.render(labels, values, asset, assets)
+        body = self.body_template.render(labels, values, asset, assets)
         mail = Email((values['label'], values['email']) if values is not None else None, title.split('\n')[0], body) # truncate title to one line
-        for user in sql.selectAllDict("SELECT label, email FROM user, enum, enum_entry WHERE role IN ({0}) AND field='user' AND enum.enum_id=enum_entry.enum_id AND value=user.user_id".format(','.join([str(role_id) for role_id in self.roles]))):
-            mail.add_cc((user['label'], user['email']))
+        for recipient in self.recipients:
+            mail.add_cc(recipient)
         return mail
 
     def check_run(self, now, sql):
@@ -179,52 +318,101 @@ class Notification(object):
             raise Exception("Bad value for 'every' for notification id {0}".format(self.id))
         return sql.selectSingle("SELECT :run < DATE(:now, :every, :offset)", run=self.run, now=now, every=every, offset=offset) == 1
 
+    def _asset_fields(self, trigger):
+        """ Return the asset fields needed to filter a trigger's assets and fill in the templates.
+        """
+        fields = set(['id'])
+        fields.update(f.field for f in trigger.filters if f.field is not None)
+        fields.update(self.title_template.fields)
+        fields.update(self.body_template.fields)
+        return sorted(fields)
+
     def _sign(self, x):
         # return the integer x with sign
         return '{0}{1}'.format('+' if x >= 0 else '', str(x))
 
-    def run_now(self, now, sql, index):
-        """ Triggers are ORed - if any fire, yield a mail.
+    def run_now(self, now, sql, index, assets=None, labels=None):
+        """ Triggers are ORed - if any fire, yield a mail. Assets for booking column triggers
+            are fetched through the given AssetCache, and enum labels are taken from the given
+            enum_labels() dictionary, if any.
         """
         log.debug("Running notification %s: %s", self.id, self.name)
+        if assets is None:
+            assets = AssetCache(index)
+        if labels is None:
+            labels = enum_labels(sql)
         if not debug:
             sql.insert("UPDATE notification SET run=DATE(:now) WHERE notification_id=:notification_id", notification_id=self.id, now=now)
         for trigger in self.triggers:
             if trigger.column is not None:
-                for values in sql.selectAllDict("SELECT * FROM booking, user, enum, enum_entry WHERE DATE(:now) >= date(booking.{0}, '{1} DAYS') AND booking.user_id=user.user_id AND enum.field='user' AND enum.enum_id=enum_entry.enum_id AND enum_entry.value=user.user_id".format(trigger.column, trigger.days), now=now):
-                    asset = index.get(values['asset_id'])
+                rows = sql.selectAllDict("SELECT * FROM booking, user, enum, enum_entry WHERE DATE(:now) >= date(booking.{0}, '{1} DAYS') AND booking.user_id=user.user_id AND enum.field='user' AND enum.enum_id=enum_entry.enum_id AND enum_entry.value=user.user_id".format(trigger.column, trigger.days), now=now)
+                assets.fetch(values['asset_id'] for values in rows)
+                for values in rows:
+                    asset = assets.get(values['asset_id'])
                     if asset is None:
                         log.debug("Asset with id %d no longer exists - skipping", values['asset_id'])
                         continue
                     if trigger._filter(values, asset):
-                        yield self._mail(sql, values, asset)
+                        yield self._mail(sql, labels, values, asset)
             elif trigger.field is not None:
                 if trigger.days >= 0:
                     q = '{0}:[* TO {1}{2}DAYS]'.format(trigger.field, now.upper(), self._sign(-trigger.days))
                 else:
                     q = '{0}:[{1}{2}DAYS TO *]'.format(trigger.field, now.upper(), self._sign(trigger.days))
-                #FIXME here and below it would be better to allow SOLR to do the filtering
-                for asset in filter(lambda x: trigger._filter(None, x), index.search({'q': q, 'rows': 100000})['response']['docs']):
-                    yield self._mail(sql, None, asset)
+                for asset in index.iter_docs([('q', q)] + trigger.fq(), self._asset_fields(trigger)):
+                    if trigger._filter(None, asset, True):
+                        yield self._mail(sql, labels, None, asset)
             else:
                 # it's a report, which means trigger all assets (satisfying filters), and group hits into one email
-                assets = filter(lambda x: trigger._filter(None, x), index.search({'q': '*', 'rows': 100000})['response']['docs'])
-                yield self._mail(sql, None, None, assets)
+                assets = [asset for asset in index.iter_docs([('q', '*')] + trigger.fq(), self._asset_fields(trigger)) if trigger._filter(None, asset, True)]
+                yield self._mail(sql, labels, None, None, assets)
+
 
+def load_notification_dicts(sql, notification_id=None):
+    """ Load all notifications, or the one with the given id, in a fixed number of queries.
+        Returns a list of notification dictionaries, each with a list of roles and a list of
+        trigger dictionaries, each of which has a list of filter dictionaries.
+    """
+    notifications = sql.selectAllDict(NOTIFICATIONS_SQL, notification_id=notification_id)
+    by_id = {}
+    for notification in notifications:
+        notification['roles'] = []
+        notification['triggers'] = []
+        by_id[notification['notification_id']] = notification
+    for role_id, role in sql.selectAll(ROLES_SQL, notification_id=notification_id):
+        if role_id in by_id:
+            by_id[role_id]['roles'].append(role)
+    triggers = {}
+    for trigger in sql.selectAllDict(TRIGGERS_SQL, notification_id=notification_id):
+        trigger['filters'] = []
+        if trigger['notification_id'] in by_id:
+            by_id[trigger['notification_id']]['triggers'].append(trigger)
+            triggers[trigger['trigger_id']] = trigger
+    for filter in sql.selectAllDict(FILTERS_SQL, notification_id=notification_id):
+        if filter['trigger_id'] in triggers:
+            triggers[filter['trigger_id']]['filters'].append(filter)
+    return notifications
+
+def load_plan(sql, notification_id=None):
+    """ Return a list of Notification objects for all notifications, or the one with the given
+        id, with mail recipients resolved - in a fixed number of queries.
+    """
+    users = sql.selectAllDict(RECIPIENTS_SQL)
+    plan = []
+    for n_dict in load_notification_dicts(sql, notification_id):
+        triggers = [Trigger(**dict(t_dict, filters=[Filter(**f_dict) for f_dict in t_dict['filters']])) for t_dict in n_dict['triggers']]
+        recipients = [(user['label'], user['email']) for user in users if user['role'] in n_dict['roles']]
+        plan.append(Notification(**dict(n_dict, triggers=triggers, recipients=recipients)))
+    return plan
 
 def run_notifications(now, db, index):
     log.info("Running notifications")
+    assets = AssetCache(index)
     with db.cursor() as sql:
-        for n_dict in sql.selectAllDict("SELECT * FROM notification"):
-            roles = sql.selectAllSingle("SELECT role FROM notification_role_pivot WHERE notification_id=:notification_id", n_dict)
-            triggers = []
-            for t_dict in sql.selectAllDict("SELECT * FROM trigger WHERE notification_id=:notification_id", n_dict):
-                f_dicts = sql.selectAllDict("SELECT * FROM trigger_filter WHERE trigger_id=:trigger_id", t_dict)
-                filters = [Filter(**f) for f in f_dicts]
-                triggers.append(Trigger(filters, **t_dict))
-            notification = Notification(roles, triggers, **n_dict)
+        labels = enum_labels(sql)
+        for notification in load_plan(sql):
             if notification.check_run(now, sql):
-                for mail in notification.run_now(now, sql, index):
+                for mail in notification.run_now(now, sql, index, assets, labels):
                     yield mail
 
 
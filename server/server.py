@@ -8,14 +8,24 @@ import functools
 import requests
 import httplib
 import hashlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from sql import SqlDatabase, NoResult
 import mimetypes
 from werkzeug.local import LocalProxy
-from flask import Flask, redirect, request, Response, send_file, g
+from werkzeug.datastructures import ContentRange
+from flask import Flask, redirect, request, Response, send_file, g, stream_with_context, after_this_request
 from flask_login import LoginManager, login_required, current_user, login_user, logout_user
 from user_app import UserApplication, ADMIN_ROLE, BOOK_ROLE, VIEW_ROLE
 from solr import SolrError, AssetIndex
-from config import SOLR_COLLECTION
+from enums import EnumRegistry
+from storage import get_store, MissingBody
+from cache import ResultCache
+from jobs import JobRunner
+from usage import get_usage, update_usage, merge_usage, reconcile, reconciled_fields
+from counters import CURRENT_USER_SUMMARY_SQL
+from notifications import load_notification_dicts
+from config import DATABASE, SOLR_COLLECTION, SEARCH_CACHE_SIZE, SEARCH_THREADS, MERGE_SYNC_LIMIT
 
 if __name__ == '__main__':
     # development environment (run locally with "python server.py debug" at URL http://localhost:3389/static/index.html)
@@ -24,6 +34,10 @@ else:
     # production environment (run by Apache mod_wsgi at URL http://server/)
     application = UserApplication(__name__, static_folder=None) # pylint: disable=invalid-name
 application.solr = AssetIndex(SOLR_COLLECTION)
+application.enums = EnumRegistry()
+application.store = get_store()
+application.search_cache = ResultCache(SEARCH_CACHE_SIZE)
+application.executor = ThreadPool(SEARCH_THREADS) # for SOLR requests made concurrently with SQL work
 
 CONDITION_FIELD = 'condition'
 CONDITION_DATE_FIELD = 'condition_date'
@@ -33,18 +47,26 @@ XJOIN_PREFIX = 'xjoin_'
 DATE_BRACKETS = ['[', ']']
 DIRECTION_CHARS = ['<', '>', '@']
 
-MERGE_ROWS = 10
+AVAILABILITY_BATCH = 500 # asset ids per availability query, within SQLite's bound parameter limit
 
+# search results depend on the bookings, enums and projects (via xjoin and the enum sort) and on the date
+SEARCH_VERSION_SQL = "SELECT date('now'), group_concat(name || ':' || version) FROM (SELECT name, version FROM version ORDER BY name)"
+
+# booking counts per project are maintained by triggers (see migrations.py and counters.py)
+PROJECT_COUNTS_SQL = "SELECT project, n FROM project_booking_count WHERE n > 0"
+
+PROJECT_USAGE_SQL = "SELECT project_id, IFNULL(n, 0) AS n FROM project LEFT JOIN project_booking_count ON project_id=project"
+
+DELETE_ENTRY_SQL = "DELETE FROM enum_entry WHERE value=:value AND enum_id=(SELECT enum_id FROM enum WHERE field=:field)"
+
+# booking counts per user are maintained by triggers (see migrations.py and counters.py)
 USER_BOOKING_SUMMARY_SQL = """
   SELECT user.user_id, username, label, role, email, last_login,
-         COUNT(CASE WHEN IFNULL(in_date, due_in_date) >= date('now') OR (out_date IS NOT NULL AND in_date IS NULL) THEN 1 ELSE NULL END) AS booked,
-         COUNT(CASE WHEN out_date IS NOT NULL AND in_date IS NULL THEN 1 ELSE NULL END) AS out,
-         COUNT(CASE WHEN out_date IS NOT NULL AND in_date IS NULL AND due_in_date < date('now') THEN 1 ELSE NULL END) AS overdue
-    FROM enum, enum_entry, user LEFT JOIN booking ON booking.user_id=user.user_id
+         IFNULL(booked, 0) AS booked, IFNULL(out, 0) AS out, IFNULL(overdue, 0) AS overdue
+    FROM enum, enum_entry, user LEFT JOIN ({0}) AS summary ON summary.user_id=user.user_id
    WHERE field='user' AND enum.enum_id=enum_entry.enum_id AND enum_entry.value=user.user_id
-GROUP BY user.user_id
 ORDER BY `order`
-"""
+""".format(CURRENT_USER_SUMMARY_SQL)
 
 # use either EXTANT_CLAUSE or RANGE_CLAUSE for substitution {2}
 BOOKINGS_SQL = """
@@ -67,23 +89,71 @@ RANGE_CLAUSE = "(IFNULL(in_date, due_in_date) >= :from_date AND due_out_date <=
 
 # the IFNULL ensures that in_date is used in preference to due_in_date, should it be non-null, so that a user can book
 # an asset where it has been returned early, and can not book an asset that has been returned late (in both cases where
-# the requested booking would have overlapped or not with the previous booking)
+# the requested booking would have overlapped or not with the previous booking) - candidates are found with the
+# booking_rtree interval index (see migrations.py, CROSS JOIN makes SQLite use it first), then the exact predicates applied
 CHECK_BOOKING_SQL = """
-  SELECT booking_id, booking.user_id AS user_id, enum_entry.label AS user_label
-    FROM booking, user, enum, enum_entry
-   WHERE asset_id=:asset_id AND booking.user_id=user.user_id
+  SELECT booking.booking_id, booking.user_id AS user_id, enum_entry.label AS user_label
+    FROM booking_rtree CROSS JOIN booking, user, enum, enum_entry
+   WHERE booking_rtree.min_asset<=:asset_id AND booking_rtree.max_asset>=:asset_id
+         AND booking_rtree.start<IFNULL(julianday(:due_in_date) - 2440587.5, 1e7)
+         AND booking_rtree.end>IFNULL(julianday(:due_out_date) - 2440587.5, -1e7)
+         AND booking.booking_id=booking_rtree.booking_id
+         AND asset_id=:asset_id AND booking.user_id=user.user_id
          AND :due_in_date > due_out_date AND :due_out_date < IFNULL(in_date, due_in_date)
          AND field='user' AND enum_entry.enum_id=enum.enum_id AND enum_entry.value=user.user_id
 """
 
-# similar to above but check for clash when updating
+# similar to above but check for clash when updating, using any newly supplied dates over the existing ones
 CHECK_CLASH_SQL = """
   SELECT other.booking_id, other.user_id AS user_id, enum_entry.label AS user_label
-    FROM booking, booking AS other, user, enum, enum_entry
-   WHERE booking.booking_id=:booking_id AND other.booking_id!=booking.booking_id
+    FROM booking CROSS JOIN booking_rtree CROSS JOIN booking AS other, user, enum, enum_entry
+   WHERE booking.booking_id=:booking_id
+         AND booking_rtree.min_asset<=booking.asset_id AND booking_rtree.max_asset>=booking.asset_id
+         AND booking_rtree.start<IFNULL(julianday(IFNULL(:due_in_date, booking.due_in_date)) - 2440587.5, 1e7)
+         AND booking_rtree.end>IFNULL(julianday(IFNULL(:due_out_date, booking.due_out_date)) - 2440587.5, -1e7)
+         AND other.booking_id=booking_rtree.booking_id AND other.booking_id!=booking.booking_id
+         AND other.asset_id=booking.asset_id AND other.user_id=user.user_id
+         AND IFNULL(other.in_date, other.due_in_date) > IFNULL(:due_out_date, booking.due_out_date)
+         AND other.due_out_date < IFNULL(:due_in_date, booking.due_in_date)
+         AND field='user' AND enum_entry.enum_id=enum.enum_id AND enum_entry.value=user.user_id
+"""
+
+# bookings that would clash with a booking from :from_date to :to_date for any of the asset ids in
+# substitution {0}, which are looked up one by one in the interval index (not using WITH for the ids,
+# as the Python 2 sqlite3 module commits before any statement not starting SELECT, INSERT, ...)
+AVAILABILITY_SQL = """
+  SELECT booking.asset_id, booking.booking_id, booking.due_out_date, booking.due_in_date, booking.in_date
+    FROM (SELECT column1 AS asset_id FROM (VALUES {0})) AS ids CROSS JOIN booking_rtree CROSS JOIN booking
+   WHERE booking_rtree.min_asset<=ids.asset_id AND booking_rtree.max_asset>=ids.asset_id
+         AND booking_rtree.start<IFNULL(julianday(:to_date) - 2440587.5, 1e7)
+         AND booking_rtree.end>IFNULL(julianday(:from_date) - 2440587.5, -1e7)
+         AND booking.booking_id=booking_rtree.booking_id AND booking.asset_id=ids.asset_id
+         AND :to_date > booking.due_out_date AND :from_date < IFNULL(booking.in_date, booking.due_in_date)
+ORDER BY booking.asset_id, booking.due_out_date
+"""
+
+ADD_BOOKING_SQL = """
+  INSERT INTO booking
+       VALUES (NULL, :asset_id, :user_id, datetime('now'), :due_out_date, :due_in_date, NULL, NULL, NULL, NULL, :project, :notes)
+"""
+
+# bookings clashing with any of the (new) bookings whose ids are in substitution {0} - used to check
+# a bulk booking after inserting it, so that the whole check is made while holding the write lock
+BULK_CLASH_SQL = """
+  SELECT booking.asset_id, other.booking_id,
+         other.user_id AS user_id, enum_entry.label AS user_label,
+         other.due_out_date, other.due_in_date, other.in_date
+    FROM (SELECT column1 AS booking_id FROM (VALUES {0})) AS new CROSS JOIN booking CROSS JOIN booking_rtree CROSS JOIN booking AS other, user, enum, enum_entry
+   WHERE booking.booking_id=new.booking_id
+         AND booking_rtree.min_asset<=booking.asset_id AND booking_rtree.max_asset>=booking.asset_id
+         AND booking_rtree.start<IFNULL(julianday(booking.due_in_date) - 2440587.5, 1e7)
+         AND booking_rtree.end>IFNULL(julianday(booking.due_out_date) - 2440587.5, -1e7)
+         AND other.booking_id=booking_rtree.booking_id AND other.booking_id!=booking.booking_id
          AND other.asset_id=booking.asset_id AND other.user_id=user.user_id
-         AND IFNULL(other.in_date, other.due_in_date) > {0} AND other.due_out_date < {1}
+         AND IFNULL(other.in_date, other.due_in_date) > booking.due_out_date
+         AND other.due_out_date < booking.due_in_date
          AND field='user' AND enum_entry.enum_id=enum.enum_id AND enum_entry.value=user.user_id
+ORDER BY booking.asset_id, other.due_out_date
 """
 
 CHECK_OUT_SQL = """
@@ -107,7 +177,7 @@ CHECK_IN_SQL = """
 """.format(BOOK_ROLE, CONDITION_FIELD)
 
 GET_ATTACHMENT_SQL = """
-  SELECT name, data
+  SELECT name, hash, size
     FROM attachment
    WHERE attachment_id=:attachment_id
 """
@@ -197,8 +267,9 @@ def user_admin_endpoint(user_id=None):
             # number of assets 'out' (i.e. have been taken out and not returned),
             # number of assets 'overdue' (i.e. should have been returned by today, but hasn't been)
             users = sql.selectAllDict(USER_BOOKING_SUMMARY_SQL)
+            logged_in = set(application.logged_in_users.users())
             for user in users:
-                user['logged_in'] = user['user_id'] in application.logged_in_users
+                user['logged_in'] = user['user_id'] in logged_in
             return json.dumps(users)
     elif request.method == 'POST':
         new_user = request.get_json()
@@ -229,6 +300,13 @@ def user_admin_endpoint(user_id=None):
             sql.delete("DELETE FROM booking WHERE user_id=:user_id", user_id=user_id)
         return json.dumps({})
 
+@application.route('/stats')
+@application.role_required([ADMIN_ROLE])
+def stats_endpoint():
+    """ Endpoint for server performance counters.
+    """
+    return json.dumps({'solr': application.solr.stats(), 'sql': application.sql_stats(), 'search_cache': application.search_cache.stats()})
+
 @application.errorhandler(SolrError)
 def handle_solr_error(error):
     """ Error handler for SolrError - just pass forward the status code.
@@ -241,11 +319,112 @@ def get_counts(sql, field):
     """
     if field == 'project':
         # treat project specially, as it's a booking field, not a SOLR field. Take care to include 0s, because we need them for checking whether to delete a project
-        return dict((str(d['project_id']), d['n']) for d in sql.selectAllDict("SELECT project_id, COUNT(project) AS n FROM project LEFT JOIN booking ON project_id=project GROUP BY project_id"))
+        return dict((str(d['project_id']), d['n']) for d in sql.selectAllDict(PROJECT_USAGE_SQL))
     else:
-        r = application.solr.search([('q', '*'), ('rows', 0), ('facet', 'true'), ('facet.field', field)])
-        facets = r['facet_counts']['facet_fields'][field]
-        return dict(zip(facets[::2], facets[1::2]))
+        return get_usage(sql, application.solr, field)
+
+def prune_enum(sql, field, enum_id):
+    """ Delete the entries of an enum whose values are not in use, returning the remaining entries.
+    """
+    counts = get_counts(sql, field)
+    for entry in sql.selectAllDict("SELECT entry_id, value FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id):
+        if counts.get(str(entry['value']), 0) == 0:
+            sql.delete("DELETE FROM enum_entry WHERE entry_id=:entry_id", entry_id=entry['entry_id'])
+            # we need to do more to delete a project
+            if field == 'project':
+                sql.delete("DELETE FROM project WHERE project_id=:project_id", project_id=entry['value'])
+    return sql.selectAllDict("SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id)
+
+def _merge_job(job, field, source, target):
+    """ Job merging the source value of an enum field into the target value, in SOLR.
+    """
+    total = application.solr.search([('q', '{0}:"{1}"'.format(field, source)), ('rows', 0)])['response']['numFound']
+    job.progress(0, total)
+    try:
+        merged = application.solr.merge_field(field, source, target, lambda done: job.progress(done, total))
+    except Exception:
+        # if cancelled or failed, SOLR can't roll back the updates already sent, so make them
+        # visible now (the job records how many were merged) with usage counts to match
+        application.solr.commit()
+        with job.db.cursor() as sql:
+            if field in reconciled_fields(sql):
+                reconcile(sql, application.solr, field)
+        raise
+    # the source entry goes only once every asset has been merged, so a failed or cancelled job leaves it in place
+    with job.db.cursor() as sql:
+        sql.delete(DELETE_ENTRY_SQL, field=field, value=source)
+        merge_usage(sql, field, source, target)
+    return {'merged': merged}
+
+def _reconcile_job(job, fields=None):
+    """ Job reconciling enum usage counts (for the given fields, or all maintained fields) with SOLR.
+    """
+    with job.db.cursor() as sql:
+        fields = fields or sorted(reconciled_fields(sql))
+    result = {}
+    for done, field in enumerate(fields):
+        with job.db.cursor() as sql:
+            result[field] = reconcile(sql, application.solr, field)
+        job.progress(done + 1, len(fields))
+    return result
+
+def _prune_job(job, field):
+    """ Job deleting the unused entries of an enum.
+    """
+    with job.db.cursor() as sql:
+        enum_id = sql.selectSingle("SELECT enum_id FROM enum WHERE field=:field", field=field)
+        return prune_enum(sql, field, enum_id)
+
+application.jobs = JobRunner(DATABASE, log=application.logger)
+application.jobs.register('merge', _merge_job)
+application.jobs.register('prune', _prune_job)
+application.jobs.register('reconcile', _reconcile_job)
+
+@application.before_first_request
+def _start_jobs():
+    """ Start the job runner with the server, so that interrupted and queued jobs are dealt with.
+    """
+    if not application.migrated:
+        application._migrate() # pylint: disable=protected-access
+    application.jobs.start()
+
+@application.route('/job', methods=['GET'])
+@application.role_required([ADMIN_ROLE])
+def jobs_endpoint():
+    """ Endpoint for listing recent background jobs.
+    """
+    with application.db.cursor() as sql:
+        return json.dumps(application.jobs.list(sql))
+
+@application.route('/job/<kind>', methods=['POST'])
+@application.role_required([ADMIN_ROLE])
+def job_submit_endpoint(kind):
+    """ Endpoint for submitting a background job, with its parameters as JSON.
+    """
+    try:
+        job_id = application.jobs.submit(kind, request.get_json() or {}, current_user.user_id)
+    except KeyError:
+        return "No such job kind", 404
+    with application.db.cursor() as sql:
+        rsp = Response(json.dumps(application.jobs.get(sql, job_id)), status=202, mimetype='application/json')
+    rsp.headers['Location'] = '/job/{0}'.format(job_id)
+    return rsp
+
+@application.route('/job/<int:job_id>', methods=['GET', 'DELETE'])
+@application.role_required([ADMIN_ROLE])
+def job_endpoint(job_id):
+    """ Endpoint for getting the state and progress of a background job, or cancelling it.
+    """
+    with application.db.cursor() as sql:
+        if request.method == 'DELETE' and not application.jobs.cancel(sql, job_id):
+            sql.rollback()
+            if application.jobs.get(sql, job_id) is None:
+                return "No such job", 404
+            return "Job already finished", 409
+        job = application.jobs.get(sql, job_id)
+        if job is None:
+            return "No such job", 404
+        return json.dumps(job)
 
 @application.route('/enum/<field>', methods=['PUT', 'POST'])
 @application.role_required([ADMIN_ROLE])
@@ -257,6 +436,12 @@ def enums_endpoint(field=None):
             enum_id = sql.selectSingle("SELECT enum_id FROM enum WHERE field=:field", field=field)
         except NoResult:
             return "No such enum", 404
+        if field in ['role', 'user']:
+            # role and user labels are cached with logged in users, forget them once the change is committed
+            @after_this_request
+            def _invalidate_principals(response):
+                application.principals.clear()
+                return response
         if request.method == 'PUT':
             # update all values - but check we aren't deleting labels/values that are in use
             values = request.get_json()
@@ -297,14 +482,7 @@ def enums_endpoint(field=None):
                     sql.insert("INSERT INTO enum_entry VALUES (NULL, :enum_id, :order, :value, :label)", entry)
                 return json.dumps(entry)
             elif action == 'prune':
-                counts = get_counts(sql, field)
-                for entry in sql.selectAllDict("SELECT entry_id, value FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id):
-                    if counts.get(str(entry['value']), 0) == 0:
-                        sql.delete("DELETE FROM enum_entry WHERE entry_id=:entry_id", entry_id=entry['entry_id'])
-                        # we need to do more to delete a project
-                        if field == 'project':
-                            sql.delete("DELETE FROM project WHERE project_id=:project_id", project_id=entry['value'])
-                return json.dumps(sql.selectAllDict("SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id))
+                return json.dumps(prune_enum(sql, field, enum_id))
             elif action == 'sort':
                 entries = sql.selectAllDict("SELECT entry_id, value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id)
                 entries.sort(key=lambda entry: entry['label'])
@@ -314,21 +492,56 @@ def enums_endpoint(field=None):
                 return json.dumps(entries)
             elif action == 'merge':
                 spec = request.get_json()
-                sql.delete("DELETE FROM enum_entry WHERE enum_id=:enum_id AND value=:value", enum_id=enum_id, value=spec['source'])
                 if field == 'project':
                     # treat project specially, as it's a booking field, not a SOLR field
+                    sql.delete(DELETE_ENTRY_SQL, field=field, value=spec['source'])
                     sql.update("UPDATE booking SET project=:target WHERE project=:source", spec)
-                else:
-                    while True:
-                        r = application.solr.search([('q', '{0}:{1}'.format(field, spec['source'])), ('rows', MERGE_ROWS), ('fl', 'id')])
-                        application.solr.update_field([doc['id'] for doc in r['response']['docs']], field, spec['target'])
-                        if r['response']['numFound'] < MERGE_ROWS:
-                            break
-                return json.dumps(sql.selectAllDict("SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id))
+                    return json.dumps(sql.selectAllDict("SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id))
+                total = application.solr.search([('q', '{0}:"{1}"'.format(field, spec['source'])), ('rows', 0)])['response']['numFound']
+                if total <= MERGE_SYNC_LIMIT:
+                    application.solr.merge_field(field, spec['source'], spec['target'])
+                    sql.delete(DELETE_ENTRY_SQL, field=field, value=spec['source'])
+                    merge_usage(sql, field, spec['source'], spec['target'])
+                    return json.dumps(sql.selectAllDict("SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id))
+                # a large merge runs as a background job, with progress at the returned location. The
+                # job deletes the source entry when it succeeds, so until then it is still listed
+                entries = sql.selectAllDict("SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id", enum_id=enum_id)
+                sql.commit() # jobs are recorded using a separate connection
+                job_id = application.jobs.submit('merge', {'field': field, 'source': spec['source'], 'target': spec['target']}, current_user.user_id)
+                rsp = Response(json.dumps(entries), status=202, mimetype='application/json')
+                rsp.headers['Location'] = '/job/{0}'.format(job_id)
+                return rsp
             else:
                 return "Bad action", 400
         
 
+class ServerTiming(object):
+    """ Named durations, for a Server-Timing response header.
+    """
+    def __init__(self):
+        self.entries = []
+
+    def add(self, name, ms):
+        self.entries.append((name, ms))
+
+    @contextmanager
+    def measure(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, (time() - start) * 1000)
+
+    def header(self):
+        return ', '.join('{0};dur={1:.1f}'.format(name, ms) for name, ms in self.entries)
+
+def _timed(fn, *args):
+    """ Return (result of calling fn, time taken in milliseconds).
+    """
+    start = time()
+    result = fn(*args)
+    return result, (time() - start) * 1000
+
 @application.route('/search')
 @application.route('/search/<path:path>')
 def search_endpoint(path=None):
@@ -427,22 +640,42 @@ def search_endpoint(path=None):
         for field in request.args.get('facets', '').split(','):
             params.append(('facet.field', field))
 
-    # get enum definitions
-    with application.db.cursor() as sql:
-        enums = {}
-        for enum_id, field in sql.selectAll("SELECT enum_id, field FROM enum"):
-            stmt = "SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id"
-            enums[field] = sql.selectAllDict(stmt, enum_id=enum_id)
-
-    data = {'solr': application.solr.search(params), 'enums': enums}
-
-    # add project values to SOLR facet counts
-    with application.db.cursor() as sql:
-        counts = [(row['project'], row['n']) for row in sql.selectAllDict("SELECT project, count(*) AS n FROM booking GROUP BY project")]
-        data['solr']['facet_counts']['facet_fields']['project'] = [x for c in counts for x in c]
-        data['projects'] = sql.selectAllDict("SELECT * FROM project")
-
-    return Response(json.dumps(data), mimetype='application/json')
+    timing = ServerTiming()
+    with timing.measure('total'), application.db.cursor() as sql:
+        # the SOLR results (with project counts) are cached unless forcing an enum reload, by the
+        # version of the SOLR index (which changes when any updates become visible) and the SQL data
+        cache = SEARCH_CACHE_SIZE > 0 and not request.args.get('reload_enums', False)
+        solr = None
+        if cache:
+            with timing.measure('cache'):
+                key = (getattr(current_user, 'role', None), tuple(sorted((name, unicode(value)) for name, value in params)))
+                version = (application.solr.index_version(),) + tuple(sql.selectOne(SEARCH_VERSION_SQL))
+                solr = application.search_cache.lookup(key, version)
+
+        # on a cache miss, the SOLR search runs on the executor while the SQL work is done here
+        search = application.executor.apply_async(_timed, (application.solr.search, params)) if solr is None else None
+
+        # get (cached) enum definitions and projects
+        with timing.measure('enums'):
+            enums, projects, enums_etag = application.enums.load(sql)
+
+        if search is not None:
+            with timing.measure('counts'):
+                counts = [(row['project'], row['n']) for row in sql.selectAllDict(PROJECT_COUNTS_SQL)]
+            solr, ms = search.get()
+            timing.add('solr', ms)
+            # add project values to SOLR facet counts
+            solr['facet_counts']['facet_fields']['project'] = [x for c in counts for x in c]
+            if cache:
+                application.search_cache.put(key, version, solr)
+
+    data = {'solr': solr, 'enums_etag': enums_etag, 'projects': projects}
+    if request.args.get('enums_etag') != enums_etag:
+        # the client does not already have the current enums
+        data['enums'] = enums
+    rsp = Response(json.dumps(data), mimetype='application/json')
+    rsp.headers['Server-Timing'] = timing.header()
+    return rsp
 
 
 @application.route('/asset', methods=['POST'])
@@ -459,7 +692,12 @@ def asset_endpoint(asset_id=None):
         # delete an existing asset
         if not application.user_has_role([ADMIN_ROLE]):
             return "Not authorized", 403
-        application.solr.delete(asset_id)
+        with application.db.cursor() as sql:
+            # only the fields with maintained usage counts are needed from the old asset
+            fields = reconciled_fields(sql)
+            old = application.solr.get(asset_id, fields) if len(fields) > 0 else None
+            application.solr.delete(asset_id)
+            update_usage(sql, old, None)
     else:
         # add a new asset or update an existing asset
         asset = request.get_json()
@@ -473,7 +711,11 @@ def asset_endpoint(asset_id=None):
             if asset['calibration_date'] > asset['calibration_due']:
                 return "Invalid asset data", 400
 
-        application.solr.update(asset_id, asset)
+        with application.db.cursor() as sql:
+            fields = reconciled_fields(sql)
+            old = application.solr.get(asset_id, fields) if request.method == 'PUT' and len(fields) > 0 else None
+            application.solr.update(asset_id, asset)
+            update_usage(sql, old, asset)
     return Response(json.dumps({'id': asset_id}), mimetype='application/json')
 
 
@@ -487,6 +729,42 @@ def asset_endpoint_GET(asset_id):
     return Response(json.dumps(asset), mimetype='application/json')
 
 
+def _attachment_response(attachment_id, name, hash, size):
+    """ Return a streamed response for the attachment data. The md5 hash of the data is
+        used as a strong ETag, and single byte range requests are supported. Other range
+        requests (multiple ranges, or an If-Range not matching the ETag, including any date)
+        get the full data.
+    """
+    if hash is not None and hash in request.if_none_match:
+        rsp = Response(status=304)
+        rsp.set_etag(hash)
+        return rsp
+    size = size or 0
+    start, stop, status = 0, size, 200
+    if_range = request.headers.get('If-Range')
+    if request.range is not None and len(request.range.ranges) == 1 and (if_range is None or (hash is not None and request.if_range.etag == hash)):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            rsp = Response("Range not satisfiable", 416)
+            rsp.headers['Content-Range'] = 'bytes */{0}'.format(size)
+            return rsp
+        start, stop = byte_range
+        status = 206
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    try:
+        chunks = application.store.read(application.db, attachment_id, hash, start, stop)
+    except MissingBody:
+        application.logger.error("Attachment %s has no body", attachment_id)
+        return "Attachment data missing", 500
+    rsp = Response(stream_with_context(chunks), status, mimetype=mimetype, direct_passthrough=True)
+    if status == 206:
+        rsp.content_range = ContentRange('bytes', start, stop, size)
+    rsp.content_length = stop - start
+    rsp.headers['Accept-Ranges'] = 'bytes'
+    if hash is not None:
+        rsp.set_etag(hash)
+    return rsp
+
 @application.route('/file', methods=['GET', 'POST'])
 @application.route('/file/<attachment_id>', methods=['GET', 'PUT', 'DELETE'])
 @application.route('/file/<attachment_id>/<filename>')
@@ -502,11 +780,10 @@ def file_endpoint(attachment_id=None, filename=None):
     with application.db.cursor() as sql:
         if request.method == 'GET' and attachment_id is not None:
             try:
-                name, data = sql.selectOne(GET_ATTACHMENT_SQL, attachment_id=attachment_id)
+                name, hash, size = sql.selectOne(GET_ATTACHMENT_SQL, attachment_id=attachment_id)
             except NoResult:
                 return "No such attachment", 404
-            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
-            return Response(str(data), mimetype=mimetype)
+            return _attachment_response(attachment_id, name, hash, size)
         if request.method == 'GET':
             folder_id = request.args.get('folder_id', None)
             clause = "folder_id IS NULL" if folder_id is None else "folder_id=:folder_id"
@@ -518,15 +795,13 @@ def file_endpoint(attachment_id=None, filename=None):
             return "Not authorized", 403
         if request.method == 'POST':
             name = request.args.get('name')
-            values = {'name': name, 'data': buffer(request.get_data())}
-            values['hash'] = hashlib.md5(values['data']).hexdigest()
-            values['folder_id'] = request.args.get('folder_id', None)
+            data = request.get_data()
             conflict = False
             try:
-                attachment_id, name = sql.selectOne("SELECT attachment_id, name FROM attachment WHERE hash=:hash", values)
+                attachment_id, name = sql.selectOne("SELECT attachment_id, name FROM attachment WHERE hash=:hash", hash=hashlib.md5(data).hexdigest())
                 conflict = True
             except NoResult:
-                attachment_id = sql.insert("INSERT INTO attachment VALUES (NULL, :name, :folder_id, :data, :hash)", values)
+                attachment_id = application.store.add(sql, name, request.args.get('folder_id', None), data)
             return json.dumps({'attachment_id': attachment_id, 'name': name, 'conflict': conflict})
         if request.method == 'PUT':
             # rename attachment
@@ -537,7 +812,13 @@ def file_endpoint(attachment_id=None, filename=None):
             # only allow deletion of an attachment if it is orphaned
             if sql.selectSingle(COUNT_ASSETS_FOR_ATTACHMENT_SQL, attachment_id=attachment_id) != 0:
                 return "Attachment not orphaned", 400
+            try:
+                hash = sql.selectSingle("SELECT hash FROM attachment WHERE attachment_id=:attachment_id", attachment_id=attachment_id)
+            except NoResult:
+                return "No such attachment", 404
             sql.delete(DELETE_ATTACHMENT_SQL, attachment_id=attachment_id)
+            sql.commit() # before removing the body
+            application.store.remove(sql, hash)
             return json.dumps({})
 
 @application.route('/folder', methods=['POST'])
@@ -606,6 +887,28 @@ def attachment_endpoint(**values):
             return json.dumps({})
 
 
+@application.route('/availability')
+@application.role_required([ADMIN_ROLE, BOOK_ROLE, VIEW_ROLE])
+def availability_endpoint():
+    """ Return which of the given assets (asset_id parameters, or comma separated ids) could be
+        booked from fromDate to toDate, and the clashing bookings for those that could not.
+    """
+    try:
+        asset_ids = sorted(set(int(asset_id) for arg in request.args.getlist('asset_id') for asset_id in arg.split(',')))
+        values = {'from_date': request.args['fromDate'], 'to_date': request.args['toDate']}
+    except (KeyError, ValueError):
+        return "Bad request", 400
+    unavailable = {}
+    with application.db.cursor() as sql:
+        for i in xrange(0, len(asset_ids), AVAILABILITY_BATCH):
+            batch = asset_ids[i:i + AVAILABILITY_BATCH]
+            ids = dict(('a{0}'.format(n), asset_id) for n, asset_id in enumerate(batch))
+            stmt = AVAILABILITY_SQL.format(','.join('(:{0})'.format(key) for key in sorted(ids)))
+            for booking in sql.selectAllDict(stmt, values, **ids):
+                unavailable.setdefault(booking['asset_id'], []).append(booking)
+    available = [asset_id for asset_id in asset_ids if asset_id not in unavailable]
+    return json.dumps({'available': available, 'unavailable': unavailable})
+
 @application.route('/booking', methods=['GET', 'POST'])
 @application.route('/booking/<booking_id>', methods=['PUT', 'DELETE'])
 @application.role_required([ADMIN_ROLE, BOOK_ROLE, VIEW_ROLE])
@@ -651,7 +954,7 @@ def booking_endpoint(booking_id=None):
                 return json.dumps(booking), 409
             except NoResult:
                 pass
-            args['booking_id'] = sql.insert("INSERT INTO booking VALUES (NULL, :asset_id, :user_id, datetime('now'), :due_out_date, :due_in_date, NULL, NULL, NULL, NULL, :project, :notes)", args, notes=request.get_data(), user_id=current_user.user_id)
+            args['booking_id'] = sql.insert(ADD_BOOKING_SQL, args, notes=request.get_data(), user_id=current_user.user_id)
             return json.dumps(args)
         if request.method == 'PUT':
             # update an existing booking by id
@@ -659,10 +962,8 @@ def booking_endpoint(booking_id=None):
                 return "Role required", 403
 
             # check for clashing bookings - need to use newly supplied dates over existing ones
-            due_out_date = '"{0}"'.format(request.args['due_out_date']) if 'due_out_date' in request.args else "booking.due_out_date"
-            due_in_date = '"{0}"'.format(request.args['due_in_date']) if 'due_in_date' in request.args else "booking.due_in_date"
             try:
-                booking = sql.selectOneDict(CHECK_CLASH_SQL.format(due_out_date, due_in_date), booking_id=booking_id)
+                booking = sql.selectOneDict(CHECK_CLASH_SQL, booking_id=booking_id, due_out_date=request.args.get('due_out_date'), due_in_date=request.args.get('due_in_date'))
                 return json.dumps(booking), 409
             except NoResult:
                 pass
@@ -697,6 +998,39 @@ def booking_endpoint(booking_id=None):
                 return "No deletable booking", 400
             return json.dumps({})
 
+@application.route('/booking/bulk', methods=['POST'])
+@application.role_required([ADMIN_ROLE, BOOK_ROLE])
+def bulk_booking_endpoint():
+    """ Book several assets (for example a kit) for the current user with the same dates and
+        project, all or none. The JSON body has asset_ids, due_out_date, due_in_date and
+        optionally project and notes. If any booking would clash, none are made, and the
+        response lists every clash.
+    """
+    args = request.get_json(silent=True)
+    if not isinstance(args, dict) or not isinstance(args.get('asset_ids'), list) or len(args['asset_ids']) == 0:
+        return "Bad request", 400
+    if not all(isinstance(asset_id, (int, long)) and not isinstance(asset_id, bool) for asset_id in args['asset_ids']):
+        return "Bad asset id", 400
+    if len(set(args['asset_ids'])) != len(args['asset_ids']):
+        return "Duplicate asset id", 400
+    if 'due_out_date' not in args or 'due_in_date' not in args:
+        return "Missing argument", 400
+    values = dict((key, args.get(key)) for key in ['due_out_date', 'due_in_date', 'project', 'notes'])
+    with application.db.cursor() as sql:
+        bookings = []
+        for asset_id in args['asset_ids']:
+            booking = dict(values, asset_id=asset_id)
+            booking['booking_id'] = sql.insert(ADD_BOOKING_SQL, booking, user_id=current_user.user_id)
+            bookings.append(booking)
+        clashes = []
+        for i in xrange(0, len(bookings), AVAILABILITY_BATCH):
+            ids = dict(('b{0}'.format(n), booking['booking_id']) for n, booking in enumerate(bookings[i:i + AVAILABILITY_BATCH]))
+            clashes.extend(sql.selectAllDict(BULK_CLASH_SQL.format(','.join('(:{0})'.format(key) for key in sorted(ids))), ids))
+        if len(clashes) > 0:
+            sql.rollback()
+            return json.dumps({'clashes': clashes}), 409
+        return json.dumps({'bookings': bookings})
+
 @application.route('/project/<project_id>', methods=['DELETE', 'PUT'])
 @application.role_required([ADMIN_ROLE])
 def project_endpoint(project_id):
@@ -721,8 +1055,11 @@ def book_endpoint(asset_id):
         else:
             if sql.update(CHECK_IN_SQL, asset_id=asset_id, user_id=current_user.user_id, condition=condition) < 1:
                 return "Bad request", 400
-            application.solr.update_field(asset_id, CONDITION_FIELD, condition)
-            application.solr.update_field(asset_id, CONDITION_DATE_FIELD, 'NOW')
+            maintained = CONDITION_FIELD in reconciled_fields(sql)
+            old = application.solr.get(asset_id, [CONDITION_FIELD]) if maintained else None
+            application.solr.update_fields(asset_id, {CONDITION_FIELD: condition, CONDITION_DATE_FIELD: 'NOW'})
+            if maintained:
+                update_usage(sql, old, {CONDITION_FIELD: condition}, partial=True)
         return json.dumps({})
 
 
@@ -778,19 +1115,10 @@ def notification_endpoint(notification_id=None):
     """
     with application.db.cursor() as sql:
         if request.method == 'GET':
+            notifications = load_notification_dicts(sql, notification_id)
             if notification_id is not None:
-                try:
-                    notifications = [sql.selectAllDict("SELECT * FROM notification WHERE notification_id=:notification_id", notification_id=notification_id)]
-                except NoResult:
+                if len(notifications) == 0:
                     return "No such notification", 404
-            else:
-                notifications = sql.selectAllDict("SELECT * FROM notification")
-            for notification in notifications:
-                notification['roles'] = sql.selectAllSingle("SELECT role FROM notification_role_pivot WHERE notification_id=:notification_id", notification_id=notification['notification_id'])
-                notification['triggers'] = sql.selectAllDict("SELECT * FROM trigger WHERE notification_id=:notification_id", notification_id=notification['notification_id'])
-                for trigger in notification['triggers']:
-                    trigger['filters'] = sql.selectAllDict("SELECT * FROM trigger_filter WHERE trigger_id=:trigger_id", trigger_id=trigger['trigger_id'])
-            if notification_id is not None:
                 notifications = notifications[0]
             return json.dumps(notifications)
         if request.method == 'PUT':
@@ -822,4 +1150,5 @@ def notification_endpoint(notification_id=None):
 if __name__ == '__main__':
     if 'debug' in sys.argv:
         application.debug = True
+        application.logged_in_users.timeout = None # don't timeout users when debugging
     application.run('0.0.0.0', port=3389)
@@ -0,0 +1,150 @@
+""" Registries of logged in users, with idle timeouts.
+
+    SessionRegistry is per process. SqlSessionRegistry shares sessions between server processes
+    through the session table of the SQL database (see migrations.py).
+"""
+import heapq
+import sqlite3
+from time import time
+from threading import Lock
+
+class SessionRegistry(object):
+    """ Thread safe registry of logged in users, each expiring timeout seconds after it was last
+        touched (or never, if timeout is None). Lookups are dict based. Expiry is amortized using
+        a heap of (expiry, user_id) holding at most one entry per user: an entry found to be out
+        of date, because the session was touched since, is pushed back with the new expiry.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expiries = {} # user_id: expiry time, or None
+        self.heap = []
+        self.scheduled = set() # user ids with an entry in the heap
+        self.lock = Lock()
+        self.clock = time
+
+    def _live(self, user_id, now):
+        expiry = self.expiries.get(user_id, 0)
+        return expiry is None or expiry > now
+
+    def _set(self, user_id, expiry):
+        if user_id not in self.scheduled and expiry is not None:
+            heapq.heappush(self.heap, (expiry, user_id))
+            self.scheduled.add(user_id)
+        self.expiries[user_id] = expiry
+
+    def add(self, user_id):
+        """ Record a login.
+        """
+        self.touch(user_id)
+
+    def touch(self, user_id):
+        """ Restart the idle timeout for a logged in user.
+        """
+        now = self.clock()
+        with self.lock:
+            self._set(user_id, now + self.timeout if self.timeout is not None else None)
+
+    def remove(self, user_id):
+        """ Record a logout. Does nothing if the user is not logged in.
+        """
+        with self.lock:
+            self.expiries.pop(user_id, None)
+
+    def expire(self):
+        """ Remove sessions which have timed out.
+        """
+        now = self.clock()
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                _, user_id = heapq.heappop(self.heap)
+                self.scheduled.discard(user_id)
+                expiry = self.expiries.get(user_id)
+                if expiry is None:
+                    continue # logged out
+                if expiry > now:
+                    heapq.heappush(self.heap, (expiry, user_id)) # touched since
+                    self.scheduled.add(user_id)
+                else:
+                    del self.expiries[user_id]
+
+    def __contains__(self, user_id):
+        with self.lock:
+            return self._live(user_id, self.clock())
+
+    def users(self):
+        """ Return the ids of the logged in users.
+        """
+        now = self.clock()
+        with self.lock:
+            return [user_id for user_id in self.expiries if self._live(user_id, now)]
+
+
+class SqlSessionRegistry(SessionRegistry):
+    """ Session registry persisted in the session table of the given database, so that every
+        server process sees the same logins. Each process caches sessions it has seen for up
+        to sync seconds: touches are written through at most once per sync seconds, and a user
+        not seen within sync seconds is looked up in the table. So logouts and timeouts in
+        one process are seen by the others within sync seconds.
+    """
+    def __init__(self, timeout, database, sync, db_timeout=5.0):
+        super(SqlSessionRegistry, self).__init__(timeout)
+        self.sync = sync
+        self.synced = {} # user_id: time the session was last read from or written to the table
+        self.purged = 0
+        # autocommit connection, used under the lock
+        self.db = sqlite3.connect(database, timeout=db_timeout, isolation_level=None, check_same_thread=False)
+
+    def _write(self, user_id, now):
+        self.db.execute("INSERT OR REPLACE INTO session VALUES (?, ?)", (user_id, self.expiries[user_id]))
+        self.synced[user_id] = now
+
+    def add(self, user_id):
+        now = self.clock()
+        with self.lock:
+            self._set(user_id, now + self.timeout if self.timeout is not None else None)
+            self._write(user_id, now)
+
+    def touch(self, user_id):
+        now = self.clock()
+        with self.lock:
+            self._set(user_id, now + self.timeout if self.timeout is not None else None)
+            if now >= self.synced.get(user_id, 0) + self.sync:
+                self._write(user_id, now)
+
+    def remove(self, user_id):
+        with self.lock:
+            self.expiries.pop(user_id, None)
+            self.synced.pop(user_id, None)
+            self.db.execute("DELETE FROM session WHERE user_id=?", (user_id,))
+
+    def expire(self):
+        super(SqlSessionRegistry, self).expire()
+        now = self.clock()
+        with self.lock:
+            for user_id in [user_id for user_id in self.synced if user_id not in self.expiries]:
+                del self.synced[user_id]
+            if now >= self.purged + self.sync:
+                self.db.execute("DELETE FROM session WHERE expires <= ?", (now,))
+                self.purged = now
+
+    def __contains__(self, user_id):
+        now = self.clock()
+        with self.lock:
+            if self._live(user_id, now) and now < self.synced.get(user_id, 0) + self.sync:
+                return True
+            row = self.db.execute("SELECT expires FROM session WHERE user_id=?", (user_id,)).fetchone()
+            if row is None:
+                self.expiries.pop(user_id, None)
+                self.synced.pop(user_id, None)
+                return False
+            # keep any later expiry from a touch not yet written through
+            local = self.expiries.get(user_id, 0)
+            self._set(user_id, None if row[0] is None or local is None else max(row[0], local))
+            self.synced[user_id] = now
+            return self._live(user_id, now)
+
+    def users(self):
+        now = self.clock()
+        with self.lock:
+            rows = self.db.execute("SELECT user_id FROM session WHERE expires IS NULL OR expires > ?", (now,)).fetchall()
+        return [row[0] for row in rows]
@@ -3,7 +3,10 @@
 import json
 import requests
 import httplib
-from config import BASE_SOLR_URL
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from cache import ExpiringCache
+from config import BASE_SOLR_URL, SOLR_POOL_SIZE, SOLR_POOL_BLOCK, SOLR_KEEP_ALIVE, SOLR_TIMEOUT, SOLR_COMMIT, SOLR_COMMIT_WITHIN, SOLR_PAGE_SIZE, SOLR_GET_BATCH, SOLR_UPDATE_BATCH, SOLR_VERSION_SECS
 
 class SolrError(Exception):
     """ Exception raised when SOLR returns an error status.
@@ -18,62 +21,230 @@ def assert_status_code(r, status_code):
     if r.status_code != status_code:
         raise SolrError(r.status_code)
 
+def commit_params(policy, within=SOLR_COMMIT_WITHIN):
+    """ Return the update request parameters for the given commit policy, one of 'hard'
+        (hard commit, opening a new searcher), 'soft' (soft commit), 'within' (ask SOLR
+        to commit within the given number of milliseconds) or 'explicit' (do not commit,
+        leaving it to a later call to AssetIndex.commit or to SOLR's autoCommit).
+    """
+    if policy == 'hard':
+        return {'commit': 'true'}
+    if policy == 'soft':
+        return {'softCommit': 'true'}
+    if policy == 'within':
+        return {'commitWithin': str(within)}
+    if policy == 'explicit':
+        return {}
+    raise ValueError("Bad SOLR commit policy: {0}".format(policy))
+
 class AssetIndex(object):
-    def __init__(self, collection):
+    """ Client for the SOLR asset collection. All calls share one requests session, whose
+        connection pool is thread safe, so a single AssetIndex can be used by every mod_wsgi
+        worker thread.
+    """
+    def __init__(self, collection, pool_size=SOLR_POOL_SIZE, pool_block=SOLR_POOL_BLOCK, keep_alive=SOLR_KEEP_ALIVE, timeout=SOLR_TIMEOUT, commit=SOLR_COMMIT):
+        self.commit_policy = commit
+        self.commit_params = commit_params(commit)
         self.query_url = "{0}/{1}/query".format(BASE_SOLR_URL, collection)
         self.update_url = "{0}/{1}/update".format(BASE_SOLR_URL, collection)
+        self.get_url = "{0}/{1}/get".format(BASE_SOLR_URL, collection)
+        self.luke_url = "{0}/{1}/admin/luke".format(BASE_SOLR_URL, collection)
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount(BASE_SOLR_URL, self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.lock = Lock()
+        self.calls = 0
+        self.writes = 0 # count of updates and commits
+        self.version = ExpiringCache(SOLR_VERSION_SECS)
+
+    def _request(self, method, url, **kwargs):
+        with self.lock:
+            self.calls += 1
+        return self.session.request(method, url, timeout=self.timeout, **kwargs)
+
+    def _get(self, params):
+        r = self._request('GET', self.query_url, params=params)
+        assert_status_code(r, httplib.OK)
+        return json.loads(r.text)
+
+    def stats(self):
+        """ Return connection pool counters. Connections 'reused' is the number of requests
+            that did not need a new TCP connection.
+        """
+        connections = count = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue # pool evicted since we listed the keys
+            connections += pool.num_connections
+            count += pool.num_requests
+        return {'calls': self.calls, 'writes': self.writes, 'requests': count, 'connections': connections, 'reused': count - connections}
 
     def search(self, params):
         """ Perform a SOLR search.
         """
-        r = requests.get(self.query_url, params=params)
-        assert_status_code(r, httplib.OK)
-        return json.loads(r.text)
+        return self._get(params)
+
+    def index_version(self):
+        """ Return the version of the index being searched, which changes whenever updates become
+            visible to searches, whoever made them. The version is reused for SOLR_VERSION_SECS,
+            unless this process writes to the index.
+        """
+        version = self.version.get('index')
+        if version is None:
+            writes = self.writes
+            r = self._request('GET', self.luke_url, params={'numTerms': 0, 'show': 'index', 'wt': 'json'})
+            assert_status_code(r, httplib.OK)
+            version = json.loads(r.text)['index']['version']
+            with self.lock:
+                if self.writes == writes: # not possibly from before a write made meanwhile
+                    self.version.put('index', version)
+        return version
+
+    def iter_docs(self, params, fields=None, page_size=SOLR_PAGE_SIZE):
+        """ Generate the documents matching a SOLR search, paging through the results with a
+            cursor so that only one page is held in memory at a time. The params argument is
+            a dictionary or list of (name, value) pairs, and must not include rows, start or
+            sort (results are sorted by id). If fields is given, only those fields (a list of
+            names) are returned.
+        """
+        params = params.items() if isinstance(params, dict) else list(params)
+        params += [('rows', page_size), ('sort', 'id asc')]
+        if fields is not None:
+            params.append(('fl', ','.join(fields)))
+        cursor = '*'
+        while True:
+            rsp = self._get(params + [('cursorMark', cursor)])
+            for doc in rsp['response']['docs']:
+                yield doc
+            if rsp['nextCursorMark'] == cursor:
+                return
+            cursor = rsp['nextCursorMark']
 
     def assets_dict_xjoin(self, key, value):
         """ Get a dictionary keyed by asset_id whose values are the asset details to be displayed
             for the user or project bookings table.
         """
-        docs = self.search({'q': '*', 'rows': 1000000, 'fl': 'id,barcode,manufacturer,model,condition', 'xjoin_{0}'.format(key): 'true', 'xjoin_{0}.external.{0}'.format(key): value, 'fq': '{{!xjoin}}xjoin_{0}'.format(key)})['response']['docs']
-        return dict((doc['id'], doc) for doc in docs)
+        params = {'q': '*', 'xjoin_{0}'.format(key): 'true', 'xjoin_{0}.external.{0}'.format(key): value, 'fq': '{{!xjoin}}xjoin_{0}'.format(key)}
+        return dict((doc['id'], doc) for doc in self.iter_docs(params, ['id', 'barcode', 'manufacturer', 'model', 'condition']))
 
     def new_id(self):
-        r = requests.get(self.query_url, params={'q': '*', 'rows': 1, 'fl': 'id', 'sort': 'id desc'})
-        assert_status_code(r, httplib.OK)
-        rsp = json.loads(r.text)
+        rsp = self._get({'q': '*', 'rows': 1, 'fl': 'id', 'sort': 'id desc'})
         docs = rsp['response']['docs']
         return str(int(docs[0]['id']) + 1) if len(docs) > 0 else 1
 
     def id_exists(self, id):
-        r = requests.get(self.query_url, params={'q': 'id:"{0}"'.format(id), 'rows': 0})
-        assert_status_code(r, httplib.OK)
-        rsp = json.loads(r.text)
+        rsp = self._get({'q': 'id:"{0}"'.format(id), 'rows': 0})
         return int(rsp['response']['numFound']) > 0
 
-    def _update(self, data):
+    def _update(self, data, commit=True):
+        """ Post an update. If commit is True, the update is committed according to the
+            configured commit policy, otherwise it is left for a later call to commit().
+        """
         headers = {'Content-Type': 'application/json'}
-        r = requests.post(self.update_url, headers=headers, params={'commit': 'true'}, data=json.dumps(data))
-        assert_status_code(r, httplib.OK)
+        params = self.commit_params if commit else {}
+        try:
+            r = self._request('POST', self.update_url, headers=headers, params=params, data=json.dumps(data))
+            assert_status_code(r, httplib.OK)
+        finally:
+            self._written()
 
-    def delete(self, asset_id):
-        self._update({'delete': asset_id})
+    def _written(self):
+        with self.lock:
+            self.writes += 1
+            self.version.invalidate('index')
 
-    def update(self, asset_id, asset):
+    def commit(self):
+        """ Commit outstanding updates - a soft commit under the 'soft' policy, otherwise a
+            hard commit.
+        """
+        command = {'commit': {'softCommit': True} if self.commit_policy == 'soft' else {}}
+        headers = {'Content-Type': 'application/json'}
+        try:
+            r = self._request('POST', self.update_url, headers=headers, data=json.dumps(command))
+            assert_status_code(r, httplib.OK)
+        finally:
+            self._written()
+
+    def delete(self, asset_id, commit=True):
+        self._update({'delete': asset_id}, commit)
+
+    def update(self, asset_id, asset, commit=True):
         data = {'add': {'doc': asset}}
         data['add']['doc']['id'] = asset_id
         if '_version_' in data['add']['doc']:
             del data['add']['doc']['_version_']
-        self._update(data)
+        self._update(data, commit)
 
-    def update_field(self, asset_id_or_list, field, value):
-        try:
-            self._update([{'id': asset_id, field: {'set': value}} for asset_id in asset_id_or_list])
-        except TypeError:
-            self._update([{'id': asset_id_or_list, field: {'set': value}}])
+    def update_fields(self, asset_id_or_list, fields, commit=True):
+        """ Atomically set several fields of one or more assets in a single update request.
+            The fields argument is a dictionary from field name to new value.
+        """
+        if isinstance(asset_id_or_list, (basestring, int, long)):
+            asset_id_or_list = [asset_id_or_list]
+        docs = []
+        for asset_id in asset_id_or_list:
+            doc = dict((field, {'set': value}) for field, value in fields.iteritems())
+            doc['id'] = asset_id
+            docs.append(doc)
+        if len(docs) > 0:
+            self._update(docs, commit)
 
-    def get(self, asset_id):
-        r = requests.get(self.query_url, params={'q': 'id:{0}'.format(asset_id)})
-        assert_status_code(r, httplib.OK)
-        rsp = json.loads(r.text)
+    def update_field(self, asset_id_or_list, field, value, commit=True):
+        self.update_fields(asset_id_or_list, {field: value}, commit)
+
+    def merge_field(self, field, source, target, progress=None, batch=SOLR_UPDATE_BATCH):
+        """ Set the field to target for every asset where it is source, streaming the matching
+            ids through a cursor and sending batch atomic updates per request, with a single
+            commit at the end. If given, progress is called with the number of assets updated
+            so far after each batch. Returns the number of assets updated.
+        """
+        done = 0
+        asset_ids = []
+        for doc in self.iter_docs({'q': '{0}:"{1}"'.format(field, source)}, ['id']):
+            asset_ids.append(doc['id'])
+            if len(asset_ids) == batch:
+                self.update_field(asset_ids, field, target, commit=False)
+                done += len(asset_ids)
+                asset_ids = []
+                if progress is not None:
+                    progress(done)
+        self.update_field(asset_ids, field, target, commit=False)
+        done += len(asset_ids)
+        self.commit()
+        if progress is not None:
+            progress(done)
+        return done
+
+    def get(self, asset_id, fields=None):
+        """ Return the asset with the given id, or None. If fields is given, only those fields
+            (an iterable of names) are returned.
+        """
+        params = {'q': 'id:{0}'.format(asset_id)}
+        if fields is not None:
+            params['fl'] = ','.join(fields)
+        rsp = self._get(params)
         docs = rsp['response']['docs']
         return docs[0] if len(docs) > 0 else None
+
+    def get_many(self, asset_ids, fields=None, batch=SOLR_GET_BATCH):
+        """ Return a dictionary from asset id to asset for the given asset ids, using SOLR's
+            real-time get handler, batch ids per request. Ids with no asset are omitted. If
+            fields is given, only those fields (a list of names) are returned.
+        """
+        asset_ids = list(asset_ids)
+        assets = {}
+        for i in xrange(0, len(asset_ids), batch):
+            params = {'ids': ','.join(str(asset_id) for asset_id in asset_ids[i:i + batch])}
+            if fields is not None:
+                params['fl'] = ','.join(fields)
+            r = self._request('GET', self.get_url, params=params)
+            assert_status_code(r, httplib.OK)
+            for doc in json.loads(r.text)['response']['docs']:
+                assets[doc['id']] = doc
+        return assets
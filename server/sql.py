@@ -1,38 +1,189 @@
 import sqlite3
-from threading import Lock
+from time import time, sleep
+from threading import Lock, Condition
+
+LOCKED_ERRORS = ['database is locked', 'database table is locked']
+FETCH_SIZE = 1000 # rows per fetch when iterating over results
 
 class NoResult(Exception):
     pass
 
 
+class PoolTimeout(Exception):
+    """ Exception raised when no pooled connection becomes free in time.
+    """
+    pass
+
+
+def _locked(e):
+    """ Return whether the OperationalError e means a lock could not be obtained in time.
+    """
+    return str(e) in LOCKED_ERRORS
+
+
+class SqlStats(object):
+    """ Thread safe counters, for connection pool and lock wait statistics.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.counts)
+
+
 class SqlDatabase(object):
-    def __init__(self, database, debug=False):
-        self.db = sqlite3.connect(database, isolation_level='EXCLUSIVE')
+    def __init__(self, database, debug=False, isolation_level='EXCLUSIVE', timeout=5.0, retries=0, stats=None, pool=None, readonly=False):
+        self.db = sqlite3.connect(database, isolation_level=isolation_level, timeout=timeout, check_same_thread=pool is None)
         self.lock = Lock()
         self.debug = debug
+        self.retries = retries
+        self.stats = stats
+        self.pool = pool
+        self.readonly = readonly
 
     def cursor(self):
         with self.lock: #FIXME this is pretty cavalier, only one cursor will be allowed at a time. May need to revisit
-            return SqlCursor(self.db, self.debug)
+            return SqlCursor(self.db, self.debug, self.retries, self.stats)
 
     def close(self):
-        self.db.close()
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            self.db.close()
+
+
+class SqlPool(object):
+    """ Pool of connections to a database in WAL mode, so that readers are not blocked by a
+        writer. Read-only connections run in autocommit mode; writable connections start an
+        'IMMEDIATE' transaction at their first write, which lasts until the cursor commits.
+        A connection obtained from acquire() goes back to the pool when it is closed.
+
+        Being autocommit, a read-only connection sees each statement's own snapshot, so a
+        handler making several queries may see writes committed between them. One needing a
+        consistent view must use a single statement, or a writable connection.
+    """
+    def __init__(self, database, size, timeout=5.0, retries=3, debug=False, wait=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.wait = wait # seconds to wait for a free connection, or None for no limit
+        self.retries = retries
+        self.debug = debug
+        self.stats = SqlStats()
+        self.condition = Condition()
+        self.idle = {True: [], False: []} # keyed by whether read-only
+        self.count = 0 # number of open connections
+        db = sqlite3.connect(database, timeout=timeout)
+        try:
+            db.execute("PRAGMA journal_mode=WAL") # persistent, so only needs doing once
+        finally:
+            db.close()
+
+    def _connect(self, readonly):
+        db = SqlDatabase(self.database, self.debug, None if readonly else 'IMMEDIATE', self.timeout, self.retries, self.stats, self, readonly)
+        db.db.execute("PRAGMA query_only={0}".format(1 if readonly else 0))
+        return db
+
+    def _discard(self, db): # pylint: disable=no-self-use
+        try:
+            db.db.close()
+        except sqlite3.Error:
+            pass # statements still referenced, the connection closes when garbage collected
+
+    def acquire(self, readonly=False):
+        """ Get a connection from the pool, waiting for one to be released if the pool is
+            at full size. Raises PoolTimeout if none is released within the pool's wait.
+        """
+        start = time()
+        with self.condition:
+            while True:
+                if len(self.idle[readonly]) > 0:
+                    self.stats.add('reused')
+                    db = self.idle[readonly].pop()
+                    break
+                if self.count < self.size or len(self.idle[not readonly]) > 0:
+                    if self.count >= self.size:
+                        # replace an idle connection of the other kind
+                        self._discard(self.idle[not readonly].pop())
+                        self.count -= 1
+                    self.count += 1
+                    db = None
+                    break
+                self.stats.add('waits')
+                remaining = self.wait - (time() - start) if self.wait is not None else None
+                if remaining is not None and remaining <= 0:
+                    self.stats.add('wait_timeouts')
+                    raise PoolTimeout()
+                self.condition.wait(remaining)
+        if db is None:
+            try:
+                db = self._connect(readonly)
+            except:
+                with self.condition:
+                    self.count -= 1
+                    self.condition.notify()
+                raise
+            self.stats.add('connects')
+        self.stats.add('acquired_ro' if readonly else 'acquired_rw')
+        self.stats.add('wait_ms', int((time() - start) * 1000))
+        return db
+
+    def release(self, db):
+        """ Return a connection to the pool, abandoning any uncommitted transaction.
+        """
+        db.db.rollback()
+        with self.condition:
+            if db in self.idle[db.readonly]:
+                return # already released
+            self.idle[db.readonly].append(db)
+            self.condition.notify()
+
+    def to_dict(self):
+        """ Return pool and lock wait statistics.
+        """
+        stats = self.stats.to_dict()
+        with self.condition:
+            stats.update({'size': self.size, 'open': self.count, 'idle': len(self.idle[True]) + len(self.idle[False])})
+        return stats
 
 
 class SqlCursor(object):
-    def __init__(self, db, debug=False):
+    def __init__(self, db, debug=False, retries=0, stats=None):
         self.db = db
         self.cursor = db.cursor()
         self._commit = False
         self.debug = debug
+        self.retries = retries
+        self.stats = stats
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
-        if self._commit:
+    def __exit__(self, exc_type, exc_value, traceback):
+        # commit any writes, unless leaving because of an exception
+        if exc_type is not None:
+            self.rollback()
+        elif self._commit:
             self.db.commit()
 
+    def commit(self):
+        """ Commit now, rather than on exit.
+        """
+        self.db.commit()
+        self._commit = False
+
+    def rollback(self):
+        """ Roll back any changes made so far, rather than committing them on exit.
+        """
+        self.db.rollback()
+        self._commit = False
+
     def _execute(self, stmt, values, kwargs):
         if values is None:
             values = {}
@@ -40,7 +191,20 @@ class SqlCursor(object):
         values.update(kwargs)
         if self.debug:
             print stmt, values
-        self.cursor.execute(stmt, values)
+        attempt = 0
+        while True:
+            start = time()
+            try:
+                self.cursor.execute(stmt, values)
+                return
+            except sqlite3.OperationalError as e:
+                if attempt >= self.retries or not _locked(e):
+                    raise
+                attempt += 1
+                sleep(0.01 * attempt)
+                if self.stats is not None:
+                    self.stats.add('lock_retries')
+                    self.stats.add('lock_wait_ms', int((time() - start) * 1000))
 
     def selectOne(self, stmt, values=None, **kwargs):
         self._execute(stmt, values, kwargs)
@@ -64,6 +228,17 @@ class SqlCursor(object):
         self._execute(stmt, values, kwargs)
         return [v[0] for v in self.cursor.fetchall()]
 
+    def selectIterSingle(self, stmt, values=None, **kwargs):
+        """ Generate the first column of each row, fetching rows in batches rather than all at once.
+        """
+        self._execute(stmt, values, kwargs)
+        while True:
+            rows = self.cursor.fetchmany(FETCH_SIZE)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row[0]
+
     def selectAllDict(self, stmt, values=None, **kwargs):
         rows = self.selectAll(stmt, values, **kwargs)
         return [dict(zip([col[0] for col in self.cursor.description], row)) for row in rows]
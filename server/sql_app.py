@@ -1,24 +1,63 @@
 """ Flask server for the Server API.
 """
-from sql import SqlDatabase
+from threading import Lock
+from sql import SqlDatabase, SqlPool, PoolTimeout
+from migrations import migrate
 from werkzeug.local import LocalProxy
-from flask import Flask, g
-from config import DATABASE
+from flask import Flask, g, request, has_request_context
+from config import DATABASE, DATABASE_POOL_SIZE, DATABASE_POOL_WAIT, DATABASE_TIMEOUT, DATABASE_RETRIES
+
+READ_METHODS = ['GET', 'HEAD']
 
 class SqlApplication(Flask):
     def __init__(self, name, **args):
         super(SqlApplication, self).__init__(name, **args)
         self.teardown_appcontext_funcs.append(self._teardown_db)
+        self.register_error_handler(PoolTimeout, self._pool_timeout)
         self.db = LocalProxy(self._get_db)
+        self.pool = None
+        self.migrated = False
+        self.migrate_lock = Lock()
+
+    def _migrate(self):
+        """ Bring the database schema up to date, once per process.
+        """
+        with self.migrate_lock:
+            if not self.migrated:
+                db = SqlDatabase(DATABASE)
+                try:
+                    migrate(db)
+                finally:
+                    db.close()
+                if DATABASE_POOL_SIZE:
+                    self.pool = SqlPool(DATABASE, DATABASE_POOL_SIZE, DATABASE_TIMEOUT, DATABASE_RETRIES, wait=DATABASE_POOL_WAIT)
+                self.migrated = True
 
     def _get_db(self):
         db = getattr(g, '_database', None)
         if db is None:
-	        db = g._database = SqlDatabase(DATABASE)
+            if not self.migrated:
+                self._migrate()
+            if self.pool is not None:
+                # GET requests don't write, so get a read-only connection (never blocked by writers)
+                readonly = has_request_context() and request.method in READ_METHODS
+                db = g._database = self.pool.acquire(readonly)
+            else:
+                db = g._database = SqlDatabase(DATABASE)
         return db
 
+    def _pool_timeout(self, e): # pylint: disable=unused-argument,no-self-use
+        """ Every pooled connection is in use (perhaps leaked, or held by slow requests), so
+            ask the client to try again later.
+        """
+        return "Database busy", 503, {'Retry-After': '1'}
+
     def _teardown_db(self, e):
         db = getattr(g, '_database', None)
         if db is not None:
             db.close()
 
+    def sql_stats(self):
+        """ Return database connection pool and lock wait statistics (if pooling).
+        """
+        return self.pool.to_dict() if self.pool is not None else {}
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+""" Attachment body storage.
+
+    Attachment bodies are content addressed by the md5 hash held in the attachment table.
+    BlobStore keeps them as BLOBs in the attachment.data column (the original scheme), while
+    FileStore keeps them in files under a root directory, sharded by hash prefix, leaving
+    only metadata in the database. FileStore still reads BLOBs not yet moved out by migrate().
+
+    Usage: storage.py <database> <root> migrate [batch size] | check [prune]
+"""
+import os
+import sys
+import errno
+import hashlib
+import tempfile
+from sql import SqlDatabase
+from config import ATTACHMENT_STORE
+
+CHUNK_SIZE = 65536
+MIGRATE_BATCH = 100
+
+ADD_ATTACHMENT_SQL = """
+  INSERT INTO attachment (name, folder_id, data, hash, size)
+       VALUES (:name, :folder_id, :data, :hash, :size)
+"""
+
+ATTACHMENT_DATA_SQL = """
+  SELECT substr(data, :start, :length)
+    FROM attachment
+   WHERE attachment_id=:attachment_id
+"""
+
+HASH_COUNT_SQL = """
+  SELECT COUNT(*)
+    FROM attachment
+   WHERE hash=:hash
+"""
+
+class MissingBody(Exception):
+    """ Exception raised when an attachment's body is neither in the database nor in a file.
+    """
+    pass
+
+
+def get_store(root=ATTACHMENT_STORE):
+    """ Return the configured attachment store.
+    """
+    return FileStore(root) if root is not None else BlobStore()
+
+
+class BlobStore(object):
+    """ Store attachment bodies as BLOBs in the attachment table.
+    """
+    def add(self, sql, name, folder_id, data):
+        """ Add an attachment with the given data, returning the new attachment id.
+        """
+        values = {'name': name, 'folder_id': folder_id, 'hash': hashlib.md5(data).hexdigest(), 'size': len(data)}
+        values['data'] = self._put(values['hash'], data)
+        return sql.insert(ADD_ATTACHMENT_SQL, values)
+
+    def _put(self, hash, data): # pylint: disable=unused-argument,no-self-use
+        """ Store the data, returning the value for the attachment.data column.
+        """
+        return buffer(data)
+
+    def read(self, db, attachment_id, hash, start, stop): # pylint: disable=unused-argument,no-self-use
+        """ Return an iterator over the bytes [start, stop) of an attachment's data, in chunks.
+            Only the requested range is read from the database. The body is found before
+            returning, so that MissingBody is raised before any response is started.
+        """
+        if stop <= start:
+            return iter([])
+        with db.cursor() as sql:
+            data = sql.selectSingle(ATTACHMENT_DATA_SQL, attachment_id=attachment_id, start=start + 1, length=stop - start)
+        if data is None:
+            raise MissingBody(attachment_id)
+        return (str(buffer(data, offset, CHUNK_SIZE)) for offset in xrange(0, len(data), CHUNK_SIZE))
+
+    def remove(self, sql, hash):
+        """ Called after an attachment row is deleted, to remove the body if unreferenced.
+        """
+        pass
+
+
+class FileStore(BlobStore):
+    """ Store attachment bodies in files named by their hash, sharded into two levels of
+        directories by hash prefix. A file is written (or found to exist) after its attachment
+        row is inserted, and removed only if no row references it after one is deleted, so that
+        with the database write lock held an upload and a delete of the same body can't race.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def add(self, sql, name, folder_id, data):
+        hash = hashlib.md5(data).hexdigest()
+        attachment_id = sql.insert(ADD_ATTACHMENT_SQL, name=name, folder_id=folder_id, data=None, hash=hash, size=len(data))
+        self._put(hash, data)
+        return attachment_id
+
+    def path(self, hash):
+        return os.path.join(self.root, hash[:2], hash[2:4], hash)
+
+    def _put(self, hash, data):
+        path = self.path(hash)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+            # write then rename, so a partly written file is never visible
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        return None
+
+    def read(self, db, attachment_id, hash, start, stop):
+        try:
+            f = open(self.path(hash), 'rb') if hash is not None else None
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            f = None
+        if f is None:
+            # not migrated out of the database yet
+            return super(FileStore, self).read(db, attachment_id, hash, start, stop)
+        return self._chunks(f, start, stop)
+
+    def _chunks(self, f, start, stop): # pylint: disable=no-self-use
+        with f:
+            f.seek(start)
+            while start < stop:
+                chunk = f.read(min(CHUNK_SIZE, stop - start))
+                if len(chunk) == 0:
+                    break
+                start += len(chunk)
+                yield chunk
+
+    def remove(self, sql, hash):
+        if hash is not None and sql.selectSingle(HASH_COUNT_SQL, hash=hash) == 0:
+            try:
+                os.remove(self.path(hash))
+            except OSError:
+                pass # never moved out of the database
+
+    def migrate(self, db, batch=MIGRATE_BATCH):
+        """ Move attachment bodies out of the database into files, committing after each batch.
+            Returns the number of attachments moved.
+        """
+        moved = 0
+        while True:
+            with db.cursor() as sql:
+                rows = sql.selectAll("SELECT attachment_id, hash, data FROM attachment WHERE data IS NOT NULL LIMIT :batch", batch=batch)
+                for attachment_id, hash, data in rows:
+                    data = str(data)
+                    actual = hashlib.md5(data).hexdigest()
+                    if actual != hash:
+                        print >>sys.stderr, "Attachment {0} has hash {1} but data hashes to {2} - using the latter".format(attachment_id, hash, actual)
+                    self._put(actual, data)
+                    sql.update("UPDATE attachment SET data=NULL, hash=:hash, size=:size WHERE attachment_id=:attachment_id", attachment_id=attachment_id, hash=actual, size=len(data))
+            moved += len(rows)
+            if len(rows) < batch:
+                return moved
+
+    def check(self, db, prune=False):
+        """ Check every attachment body is present and matches its hash and size, and look for
+            files not referenced by any attachment (deleting them if prune is True). Returns a
+            list of problem descriptions.
+        """
+        problems = []
+        with db.cursor() as sql:
+            rows = sql.selectAll("SELECT attachment_id, hash, size, data IS NULL FROM attachment")
+        hashes = set()
+        for attachment_id, hash, size, external in rows:
+            hashes.add(hash)
+            if not external:
+                continue # still in the database
+            path = self.path(hash)
+            if not os.path.exists(path):
+                problems.append("Attachment {0}: missing file {1}".format(attachment_id, path))
+                continue
+            md5 = hashlib.md5()
+            length = 0
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    md5.update(chunk)
+                    length += len(chunk)
+            if md5.hexdigest() != hash:
+                problems.append("Attachment {0}: file {1} does not match hash".format(attachment_id, path))
+            if size is not None and length != size:
+                problems.append("Attachment {0}: file {1} has size {2}, expected {3}".format(attachment_id, path, length, size))
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename not in hashes and not filename.startswith('tmp'): # ignore writes in progress
+                    path = os.path.join(directory, filename)
+                    problems.append("Unreferenced file {0}{1}".format(path, " (deleted)" if prune else ""))
+                    if prune:
+                        os.remove(path)
+        return problems
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[3] not in ['migrate', 'check']:
+        print >>sys.stderr, "Usage: {0} <database> <root> migrate [batch size] | check [prune]".format(sys.argv[0])
+        sys.exit(1)
+
+    db = SqlDatabase(sys.argv[1])
+    store = FileStore(sys.argv[2])
+    if sys.argv[3] == 'migrate':
+        batch = int(sys.argv[4]) if len(sys.argv) > 4 else MIGRATE_BATCH
+        print "Moved", store.migrate(db, batch), "attachments - VACUUM the database to reclaim the space"
+    else:
+        problems = store.check(db, len(sys.argv) > 4 and sys.argv[4] == 'prune')
+        for problem in problems:
+            print problem
+        sys.exit(1 if len(problems) > 0 else 0)
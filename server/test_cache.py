@@ -0,0 +1,35 @@
+""" Unit tests for the cache module.
+"""
+from cache import ResultCache, ExpiringCache
+
+def test_result_cache():
+    """ Check results are reused only at the same version, and the least recently used
+        result is evicted.
+    """
+    cache = ResultCache(2)
+    calls = []
+    compute = lambda value: lambda: calls.append(value) or value
+    assert cache.get('a', 1, compute('a1')) == 'a1'
+    assert cache.get('a', 1, compute('a1 again')) == 'a1'
+    assert cache.get('a', 2, compute('a2')) == 'a2'
+    assert cache.get('b', 1, compute('b1')) == 'b1'
+    assert cache.get('a', 2, compute('a2 again')) == 'a2' # a is now more recently used than b
+    assert cache.get('c', 1, compute('c1')) == 'c1' # evicts b
+    assert cache.get('b', 1, compute('b1 again')) == 'b1 again'
+    assert calls == ['a1', 'a2', 'b1', 'c1', 'b1 again']
+    assert cache.stats() == {'hits': 2, 'misses': 5, 'hit_rate': 2.0 / 7, 'entries': 2, 'size': 2}
+
+def test_expiring_cache():
+    """ Check entries expire after the ttl, and can be invalidated.
+    """
+    cache = ExpiringCache(10)
+    now = [1000.0]
+    cache.clock = lambda: now[0]
+    cache.put('a', 1)
+    cache.put('b', 2)
+    now[0] += 9
+    assert cache.get('a') == 1
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    now[0] += 1
+    assert cache.get('b') is None
@@ -0,0 +1,100 @@
+""" Unit tests for the jobs module.
+"""
+import os
+import time
+import socket
+import threading
+import subprocess
+import pytest
+from sql import SqlDatabase
+import migrations
+from jobs import JobRunner
+
+@pytest.fixture()
+def database(tmpdir):
+    path = str(tmpdir.join('jobs.db'))
+    db = SqlDatabase(path)
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    migrations.migrate(db)
+    db.close()
+    return path
+
+def _wait(runner, db, job_id, states=('done', 'failed', 'cancelled')):
+    for _ in xrange(500):
+        with db.cursor() as sql:
+            job = runner.get(sql, job_id)
+        if job['state'] in states:
+            return job
+        time.sleep(0.01)
+    raise AssertionError("Job {0} still {1}".format(job_id, job['state']))
+
+def test_jobs(database):
+    """ Check jobs run with their parameters, record progress and results, and that failures
+        and cancellations are recorded.
+    """
+    started = threading.Event()
+    def count(job, n):
+        for i in xrange(n):
+            job.progress(i + 1, n)
+        return {'counted': n}
+    def fail(job):
+        for i in xrange(3):
+            job.progress(i + 1, 10)
+        raise ValueError("bad")
+    def wait(job):
+        started.set()
+        while True:
+            job.check()
+            time.sleep(0.01)
+
+    runner = JobRunner(database, 1)
+    runner.register('count', count)
+    runner.register('fail', fail)
+    runner.register('wait', wait)
+    db = SqlDatabase(database)
+    with pytest.raises(KeyError):
+        runner.submit('nope', {})
+
+    job = _wait(runner, db, runner.submit('count', {'n': 5}, 1))
+    assert (job['state'], job['done'], job['total'], job['result'], job['params'], job['user_id']) == ('done', 5, 5, {'counted': 5}, {'n': 5}, 1)
+    job = _wait(runner, db, runner.submit('fail', {}))
+    assert (job['state'], job['error'], job['done']) == ('failed', 'bad', 3) # progress not yet written is recorded
+
+    waiting = runner.submit('wait', {})
+    queued = runner.submit('count', {'n': 1}) # behind the waiting job, on a single thread
+    started.wait(5)
+    with db.cursor() as sql:
+        assert runner.cancel(sql, queued)
+        assert runner.get(sql, queued)['state'] == 'cancelled'
+        assert runner.cancel(sql, waiting)
+    assert _wait(runner, db, waiting)['state'] == 'cancelled'
+    with db.cursor() as sql:
+        assert not runner.cancel(sql, waiting)
+        assert [job['job_id'] for job in runner.list(sql)] == [queued, waiting, 2, 1]
+
+def test_recovery(database):
+    """ Check that, when the runner starts, a job left running by a process which has gone is
+        marked as interrupted (but not one whose process is running, or on another host), and a
+        queued job is run, without any job being submitted.
+    """
+    gone = subprocess.Popen(['true'])
+    gone.wait()
+    host = socket.gethostname()
+    db = SqlDatabase(database)
+    with db.cursor() as sql:
+        add = lambda state, owner, n: sql.insert("INSERT INTO job (kind, params, state, done, owner) VALUES ('count', :params, :state, 0, :owner)", params='{{"n": {0}}}'.format(n), state=state, owner=owner)
+        running = add('running', '{0}:{1}'.format(host, gone.pid), 1)
+        live = add('running', '{0}:{1}'.format(host, os.getpid()), 1)
+        remote = add('running', 'elsewhere:1', 1)
+        queued = add('queued', None, 2)
+    runner = JobRunner(database, 1)
+    runner.register('count', lambda job, n: n)
+    runner.start()
+    with db.cursor() as sql:
+        job = runner.get(sql, running)
+        assert (job['state'], job['error']) == ('failed', 'Interrupted by a server restart')
+        assert runner.get(sql, live)['state'] == 'running'
+        assert runner.get(sql, remote)['state'] == 'running'
+    job = _wait(runner, db, queued)
+    assert (job['state'], job['result']) == ('done', 2)
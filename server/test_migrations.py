@@ -0,0 +1,130 @@
+""" Unit tests for the migrations module.
+"""
+import pytest
+from sql import SqlDatabase
+import migrations
+
+@pytest.fixture()
+def db():
+    db = SqlDatabase(':memory:')
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    return db
+
+def test_migrate(db):
+    """ Check migrations are applied once, and the schema version recorded.
+    """
+    assert migrations.schema_version(db) == 0
+    assert migrations.migrate(db) == len(migrations.MIGRATIONS)
+    assert migrations.schema_version(db) == len(migrations.MIGRATIONS)
+    assert migrations.migrate(db) == 0
+
+def test_failed_migration(db):
+    """ Check a failing migration is rolled back and leaves the schema version alone.
+    """
+    bad = migrations.MIGRATIONS[:1] + [["CREATE INDEX foo ON booking(asset_id)", "CREATE INDEX bar ON no_such_table(x)"]]
+    with pytest.raises(Exception):
+        migrations.migrate(db, bad)
+    assert migrations.schema_version(db) == 1
+    with db.cursor() as sql:
+        assert sql.selectSingle("SELECT COUNT(*) FROM sqlite_master WHERE name='foo'") == 0
+
+def test_version_triggers(db):
+    """ Check the enum version counter is bumped by enum entry changes.
+    """
+    migrations.migrate(db)
+    with db.cursor() as sql:
+        version = sql.selectSingle("SELECT version FROM version WHERE name='enum'")
+        sql.insert("INSERT INTO enum_entry VALUES (NULL, 1, 4, 4, 'Other')")
+        assert sql.selectSingle("SELECT version FROM version WHERE name='enum'") == version + 1
+
+def test_query_plans(db):
+    """ Check the hot queries all use indexes.
+    """
+    migrations.migrate(db)
+    assert migrations.check_query_plans(db, migrations.hot_queries()) == []
+
+def test_booking_rtree(db):
+    """ Check the booking interval index is kept in sync, and that clash checks using it apply
+        the exact date predicates.
+    """
+    import server # pylint: disable=import-error
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO booking VALUES (1, 7, 1, NULL, '2017-02-10', '2017-02-20', NULL, NULL, NULL, NULL, NULL, NULL)")
+    migrations.migrate(db)
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO user VALUES (1, 1, 'booker', NULL, NULL, NULL, NULL)")
+        sql.insert("INSERT INTO enum VALUES (10, 'user')")
+        sql.insert("INSERT INTO enum_entry VALUES (NULL, 10, 1, 1, 'Booker')")
+        sql.insert("INSERT INTO booking VALUES (2, 8, 1, NULL, '2017-02-10', '2017-02-20', NULL, NULL, NULL, NULL, NULL, NULL)")
+        assert sql.selectSingle("SELECT COUNT(*) FROM booking_rtree") == 2
+        clashes = lambda asset_id, out, due: sql.selectAllSingle(server.CHECK_BOOKING_SQL, asset_id=asset_id, due_out_date=out, due_in_date=due)
+        assert clashes(7, '2017-02-19', '2017-02-25') == [1]
+        assert clashes(7, '2017-02-20', '2017-02-25') == [] # due in on the day the new booking is due out
+        assert clashes(8, '2017-02-01', '2017-02-11') == [2]
+        sql.update("UPDATE booking SET in_date='2017-02-15' WHERE booking_id=1") # returned early
+        assert clashes(7, '2017-02-16', '2017-02-25') == []
+        assert clashes(7, '2017-02-14', '2017-02-25') == [1]
+        sql.delete("DELETE FROM booking WHERE booking_id=1")
+        assert clashes(7, '2017-02-14', '2017-02-25') == []
+        assert sql.selectAllSingle("SELECT booking_id FROM booking_rtree") == [2]
+        ids = sql.selectAllSingle(server.AVAILABILITY_SQL.format('(7),(8)'), from_date='2017-02-19', to_date='2017-02-25')
+        assert ids == [8]
+
+def test_project_booking_count(db):
+    """ Check the project booking counters follow booking inserts, updates and deletes, and
+        that counters.py verifies and rebuilds them.
+    """
+    import counters
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO booking VALUES (1, 7, 1, NULL, '2017-02-10', '2017-02-20', NULL, NULL, NULL, NULL, 3, NULL)")
+    migrations.migrate(db)
+    counts = lambda: dict(sql.selectAll("SELECT project, n FROM project_booking_count WHERE n > 0"))
+    with db.cursor() as sql:
+        assert counts() == {3: 1}
+        sql.insert("INSERT INTO booking VALUES (2, 8, 1, NULL, '2017-02-10', '2017-02-20', NULL, NULL, NULL, NULL, 3, NULL)")
+        sql.insert("INSERT INTO booking VALUES (3, 9, 1, NULL, '2017-02-10', '2017-02-20', NULL, NULL, NULL, NULL, NULL, NULL)")
+        assert counts() == {3: 2}
+        sql.update("UPDATE booking SET project=4 WHERE booking_id=2")
+        sql.update("UPDATE booking SET project=5 WHERE booking_id=3")
+        sql.update("UPDATE booking SET notes='x' WHERE booking_id=1")
+        assert counts() == {3: 1, 4: 1, 5: 1}
+        sql.update("UPDATE booking SET project=NULL WHERE booking_id=3")
+        sql.delete("DELETE FROM booking WHERE booking_id=1")
+        assert counts() == {4: 1}
+        assert sql.selectSingle("SELECT COUNT(*) FROM project_booking_count WHERE project IS NULL") == 0
+    assert counters.verify(db) == []
+    with db.cursor() as sql:
+        sql.update("UPDATE project_booking_count SET n=7 WHERE project=4")
+    assert counters.verify(db) == [('project_booking_count', 4, (7,), (1,))]
+    counters.rebuild(db)
+    assert counters.verify(db) == []
+
+def test_user_booking_summary(db):
+    """ Check the per-user booking summary follows booking changes, and that rows computed on
+        an earlier day are refreshed.
+    """
+    import counters
+    migrations.migrate(db)
+    summary = lambda: sql.selectAll("SELECT user_id, booked, out, overdue FROM user_booking_summary WHERE booked + out + overdue > 0 ORDER BY user_id")
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO user VALUES (1, 1, 'one', NULL, NULL, NULL, NULL)")
+        sql.insert("INSERT INTO user VALUES (2, 1, 'two', NULL, NULL, NULL, NULL)")
+        sql.insert("INSERT INTO booking VALUES (1, 7, 1, NULL, '2017-02-10', '2999-02-20', NULL, NULL, NULL, NULL, NULL, NULL)")
+        sql.insert("INSERT INTO booking VALUES (2, 8, 1, NULL, '2017-02-10', '2017-02-20', '2017-02-10', 1, NULL, NULL, NULL, NULL)")
+        assert summary() == [(1, 2, 1, 1)]
+        sql.update("UPDATE booking SET user_id=2 WHERE booking_id=1")
+        sql.update("UPDATE booking SET in_date='2017-02-19' WHERE booking_id=2")
+        assert summary() == [(2, 1, 0, 0)]
+        sql.update("UPDATE user_booking_summary SET booked=5, as_of='2017-01-01' WHERE user_id=2") # computed on an earlier day
+        assert sql.selectAll("SELECT user_id, booked FROM ({0}) WHERE booked > 0".format(counters.CURRENT_USER_SUMMARY_SQL)) == [(2, 1)]
+        counters.refresh_user_summary(sql)
+        assert summary() == [(2, 1, 0, 0)]
+        sql.delete("DELETE FROM booking WHERE booking_id=1")
+        assert summary() == []
+        sql.insert("INSERT INTO booking VALUES (3, 9, 1, NULL, '2017-02-10', '2999-02-20', NULL, NULL, NULL, NULL, NULL, NULL)")
+        sql.delete("DELETE FROM user WHERE user_id=1") # leaving the user's bookings
+        assert sql.selectAll("SELECT user_id FROM user_booking_summary ORDER BY user_id") == [(2,)]
+        sql.update("UPDATE booking SET in_date='2017-02-19' WHERE booking_id=3")
+        assert sql.selectAll("SELECT user_id FROM user_booking_summary ORDER BY user_id") == [(2,)]
+    assert counters.verify(db) == []
@@ -55,6 +55,7 @@ notifications.log = get_logger(logging.DEBUG)
 class AssetIndex(object):
     def __init__(self, assets):
         self.assets = {}
+        self.get_many_calls = 0
         self.q_re = re.compile(r"([^:]+):\[\* TO ([^Z]+Z)([+-][^D]+)DAYS\]")
         for asset in assets:
             self.assets[asset['id']] = asset
@@ -69,9 +70,17 @@ class AssetIndex(object):
                 return {'response': {'docs': docs}}
         return {}
 
+    def iter_docs(self, params, fields=None):
+        for doc in self.search(dict(params)).get('response', {}).get('docs', []):
+            yield doc if fields is None else dict((k, v) for k, v in doc.iteritems() if k in fields)
+
     def get(self, asset_id):
         return self.assets.get(asset_id, None)
 
+    def get_many(self, asset_ids, fields=None):
+        self.get_many_calls += 1
+        return dict((asset_id, self.assets[asset_id]) for asset_id in asset_ids if asset_id in self.assets)
+
 @pytest.fixture()
 def db():
     db = SqlDatabase(':memory:')
@@ -144,3 +153,64 @@ def test_overdue(db, index):
     mails = list(notifications.run_notifications('2017-02-26T00:00:00Z', db, index))
     assert len(mails) == 0
 
+
+def test_filter_fq():
+    """ Check field filters are compiled to SOLR filter queries, and column filters are not.
+    """
+    today = datetime.now().isoformat()[:10]
+    for operator, value, fq in [
+            ('==', 'null', '-calibration_due:[* TO *]'),
+            ('>=', 'null', '*:*'),
+            ('<', 'now', 'calibration_due:[* TO {0}T00:00:00Z}} OR (*:* -calibration_due:[* TO *])'.format(today)),
+            ('>', 'now', 'calibration_due:[{0}T00:00:00Z TO *]'.format(today)),
+            ('!=', '3', '-calibration_due:"3"'),
+            ('<=', '3', 'calibration_due:[* TO "3"] OR (*:* -calibration_due:[* TO *])'),
+            ('>', '3', 'calibration_due:{"3" TO *]')]:
+        assert notifications.Filter(field='calibration_due', operator=operator, value=value).fq() == fq
+    assert notifications.Filter(column='out_date', operator='==', value='null').fq() is None
+    with pytest.raises(AssertionError):
+        notifications.Filter(field='calibration_due', operator='=', value='null')
+
+def test_asset_cache(index):
+    """ Check the asset cache fetches each asset at most once.
+    """
+    assets = notifications.AssetCache(index)
+    assets.fetch([1, 1, 3])
+    assets.fetch([1, 3])
+    assert index.get_many_calls == 1
+    assert assets.get(1) == TEST_ASSETS[0]
+    assert assets.get(3) is None
+    assets.fetch([2])
+    assert index.get_many_calls == 2
+
+def test_template():
+    """ Check template rendering, including enum labels and report lines.
+    """
+    labels = {'condition': {3: 'Good'}}
+    template = notifications.Template("[label]: <serial> is <:condition>\n*<serial> <:condition> <model>")
+    assert template.fields == set(['serial', 'condition', 'model'])
+    assert template.render(labels, {'label': 'Bob'}, {'serial': 'a1', 'condition': '3'}) == "Bob: a1 is Good\n*a1 Good <BAD KEY: model>"
+    assert template.render(labels, None, None, [{'serial': 'a1', 'condition': 3}, {'serial': 'b2', 'model': 'X'}]) == \
+        "[NOT AVAILABLE]: <NOT AVAILABLE> is <bad key or no value>\na1 Good <BAD KEY: model>\nb2 <bad key or no value> X"
+
+def test_load_plan():
+    """ Check notifications are loaded with their roles, triggers, filters and recipients.
+    """
+    db = SqlDatabase(':memory:')
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+        sql.cursor.executemany("INSERT INTO user VALUES (:user_id, :role, :username, :email, NULL, NULL, NULL)", TEST_USERS)
+        enum_id = sql.insert("INSERT INTO enum VALUES (NULL, :field)", field='user')
+        sql.cursor.executemany("INSERT INTO enum_entry VALUES (NULL, :enum_id, :value, :value, :label)", [{'enum_id': enum_id, 'value': x['user_id'], 'label': x['label']} for x in TEST_USERS])
+        sql.cursor.executemany("INSERT INTO notification VALUES (:notification_id, :name, :title_template, :body_template, :every, :offset, NULL)", TEST_NOTIFICATIONS)
+        sql.cursor.executemany("INSERT INTO notification_role_pivot VALUES (NULL, :notification_id, :role)", TEST_ROLES)
+        sql.cursor.executemany("INSERT INTO trigger VALUES (NULL, :notification_id, :column, :field, :days)", TEST_TRIGGERS)
+        sql.cursor.executemany("INSERT INTO trigger_filter VALUES (NULL, :trigger_id, :column, :field, :operator, :value)", TEST_FILTERS)
+        plan = notifications.load_plan(sql)
+        assert [n.id for n in plan] == [1, 2, 3, 4]
+        assert [len(t.filters) for t in plan[2].triggers] == [2]
+        assert plan[1].recipients == [(TEST_USERS[0]['label'], TEST_USERS[0]['email']), (TEST_USERS[1]['label'], TEST_USERS[1]['email'])]
+        assert plan[3].triggers == [] and plan[3].recipients == []
+        single = notifications.load_notification_dicts(sql, 3)
+        assert len(single) == 1 and single[0]['roles'] == [ADMIN_ROLE] and len(single[0]['triggers'][0]['filters']) == 2
+        assert notifications.load_notification_dicts(sql, 99) == []
@@ -0,0 +1,71 @@
+""" Unit tests for the server endpoints.
+"""
+import json
+import pytest
+from flask import g
+from sql import SqlDatabase
+import migrations
+import server # pylint: disable=import-error
+
+class User(object):
+    user_id = 1
+    role = 1
+
+@pytest.fixture()
+def database(tmpdir, monkeypatch):
+    path = str(tmpdir.join('test.db'))
+    db = SqlDatabase(path)
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    migrations.migrate(db)
+    db.close()
+    monkeypatch.setattr(server.application, 'user_has_role', lambda roles: True)
+    monkeypatch.setitem(server.application.config, 'LOGIN_DISABLED', True)
+    monkeypatch.setattr(server, 'current_user', User())
+    return path
+
+def _call(database, endpoint, method, data, *args):
+    """ Call an endpoint function with a request body, using the given database, returning
+        (response body, status).
+    """
+    with server.application.test_request_context(method=method, data=data, content_type='application/json'):
+        g._database = SqlDatabase(database) # pylint: disable=protected-access
+        rsp = server.application.make_response(endpoint(*args))
+        return rsp.get_data(), rsp.status_code
+
+def test_bulk_booking_bad_id(database):
+    """ Check a bulk booking with a bad asset id is rejected, leaving no bookings.
+    """
+    args = {'asset_ids': [1, 'abc', 3], 'due_out_date': '2999-01-01', 'due_in_date': '2999-01-10'}
+    assert _call(database, server.bulk_booking_endpoint, 'POST', json.dumps(args))[1] == 400
+    args['asset_ids'] = [1, [2], 3]
+    assert _call(database, server.bulk_booking_endpoint, 'POST', json.dumps(args))[1] == 400
+    db = SqlDatabase(database)
+    with db.cursor() as sql:
+        assert sql.selectSingle("SELECT COUNT(*) FROM booking") == 0
+    db.close()
+
+def test_check_in_usage(database, monkeypatch):
+    """ Check that checking in an asset only reads its old condition from SOLR when the
+        condition usage counts are maintained, and then updates them.
+    """
+    gets = []
+    monkeypatch.setattr(server.application.solr, 'get', lambda asset_id, fields=None: gets.append(fields) or {'condition': 1})
+    monkeypatch.setattr(server.application.solr, 'update_fields', lambda asset_id, fields: None)
+    db = SqlDatabase(database)
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO enum VALUES (10, 'condition')")
+        sql.insert("INSERT INTO enum_entry VALUES (NULL, 10, 1, 1, 'Good')")
+        sql.insert("INSERT INTO enum_entry VALUES (NULL, 10, 2, 2, 'Bad')")
+        for asset_id in [7, 8]:
+            sql.insert("INSERT INTO booking VALUES (NULL, :asset_id, 1, NULL, '2017-02-10', '2999-02-20', '2017-02-10', 1, NULL, NULL, NULL, NULL)", asset_id=asset_id)
+    assert _call(database, server.book_endpoint, 'PUT', '2', '7')[1] == 200
+    assert gets == []
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO enum_usage VALUES ('condition', 1, 5)")
+        sql.insert("INSERT INTO enum_usage_field VALUES ('condition', datetime('now'))")
+    assert _call(database, server.book_endpoint, 'PUT', '2', '8')[1] == 200
+    assert gets == [['condition']]
+    with db.cursor() as sql:
+        assert sql.selectAll("SELECT value, n FROM enum_usage ORDER BY value") == [(1, 4), (2, 1)]
+    db.close()
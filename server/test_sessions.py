@@ -0,0 +1,90 @@
+""" Unit tests for the sessions module.
+"""
+import pytest
+from sql import SqlDatabase
+import migrations
+from sessions import SessionRegistry, SqlSessionRegistry
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture()
+def database(tmpdir):
+    path = str(tmpdir.join('sessions.db'))
+    db = SqlDatabase(path)
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    migrations.migrate(db)
+    db.close()
+    return path
+
+def _registry(registry, clock):
+    registry.clock = clock
+    return registry
+
+def test_session_registry():
+    """ Check sessions expire after the timeout unless touched, and that the expiry heap holds
+        at most one entry per user.
+    """
+    clock = Clock()
+    registry = _registry(SessionRegistry(60), clock)
+    registry.add(1)
+    registry.add(2)
+    clock.now += 50
+    registry.touch(1)
+    assert 1 in registry and 2 in registry
+    clock.now += 20
+    assert 2 not in registry
+    registry.expire()
+    assert registry.users() == [1]
+    for _ in xrange(10):
+        clock.now += 30
+        registry.touch(1)
+        registry.expire()
+    assert len(registry.heap) == 1
+    registry.remove(1)
+    registry.add(1)
+    registry.expire()
+    assert len(registry.heap) == 1
+    clock.now += 100
+    registry.expire()
+    assert registry.users() == [] and registry.expiries == {}
+
+def test_no_timeout():
+    """ Check sessions never expire if there is no timeout.
+    """
+    clock = Clock()
+    registry = _registry(SessionRegistry(None), clock)
+    registry.add(1)
+    clock.now += 1e9
+    registry.expire()
+    assert 1 in registry
+    registry.remove(1)
+    assert 1 not in registry
+
+def test_shared_sessions(database):
+    """ Check logins, logouts and timeouts are seen by other processes within the sync period.
+    """
+    clock = Clock()
+    one = _registry(SqlSessionRegistry(60, database, 10), clock)
+    two = _registry(SqlSessionRegistry(60, database, 10), clock)
+    one.add(1)
+    assert 1 in two
+    assert two.users() == [1]
+    for _ in xrange(6):
+        clock.now += 9
+        two.touch(1) # kept alive by requests to the other process
+    assert 1 in one
+    one.remove(1)
+    assert 1 in two # within the sync period
+    clock.now += 10
+    assert 1 not in two
+    two.add(2)
+    clock.now += 61
+    one.expire()
+    assert 2 not in one and 2 not in two
+    assert one.users() == []
@@ -0,0 +1,43 @@
+""" Unit tests for the solr module.
+"""
+import json
+import httplib
+from solr import AssetIndex
+
+class Response(object):
+    status_code = httplib.OK
+
+def test_commit():
+    """ Check an explicit commit sends a single commit command, soft under the 'soft' policy.
+    """
+    for policy, command in [('hard', {'commit': {}}), ('soft', {'commit': {'softCommit': True}}), ('explicit', {'commit': {}})]:
+        index = AssetIndex('test', commit=policy)
+        requests = []
+        index._request = lambda method, url, **kwargs: requests.append((method, url, kwargs)) or Response() # pylint: disable=protected-access
+        index.commit()
+        assert len(requests) == 1
+        method, url, kwargs = requests[0]
+        assert (method, url) == ('POST', index.update_url)
+        assert 'params' not in kwargs
+        assert json.loads(kwargs['data']) == command
+        assert index.writes == 1
+
+def test_index_version():
+    """ Check the index version is reused until it expires or this process writes to the index.
+    """
+    class Luke(Response):
+        text = json.dumps({'index': {'version': 7}})
+    index = AssetIndex('test')
+    requests = []
+    index._request = lambda method, url, **kwargs: requests.append(url) or Luke() # pylint: disable=protected-access
+    now = [1000.0]
+    index.version.clock = lambda: now[0]
+    assert index.index_version() == 7
+    assert index.index_version() == 7
+    assert requests == [index.luke_url]
+    index.commit()
+    assert index.index_version() == 7
+    assert requests == [index.luke_url, index.update_url, index.luke_url]
+    now[0] += index.version.ttl
+    index.index_version()
+    assert len(requests) == 4
@@ -0,0 +1,97 @@
+""" Unit tests for the sql module.
+"""
+import time
+import pytest
+import sqlite3
+from threading import Thread
+from sql import SqlDatabase, SqlPool, PoolTimeout
+
+@pytest.fixture()
+def pool(tmpdir):
+    path = str(tmpdir.join('test.db'))
+    db = SqlDatabase(path)
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    db.close()
+    return SqlPool(path, 2, timeout=1.0, retries=3)
+
+def test_wal(pool):
+    """ Check the pool puts the database in WAL mode.
+    """
+    db = pool.acquire(True)
+    with db.cursor() as sql:
+        assert sql.selectSingle("PRAGMA journal_mode") == 'wal'
+    db.close()
+
+def test_readonly(pool):
+    """ Check that read-only connections can't write, and writable connections can.
+    """
+    db = pool.acquire(True)
+    with pytest.raises(sqlite3.OperationalError):
+        with db.cursor() as sql:
+            sql.insert("INSERT INTO project VALUES (NULL, 1, 'TPR1', NULL)")
+    db.close()
+    db = pool.acquire(False)
+    with db.cursor() as sql:
+        sql.insert("INSERT INTO project VALUES (NULL, 1, 'TPR1', NULL)")
+    db.close()
+    db = pool.acquire(True)
+    with db.cursor() as sql:
+        assert sql.selectSingle("SELECT COUNT(*) FROM project") == 1
+    db.close()
+
+def test_rollback_on_exception(pool):
+    """ Check writes are rolled back, not committed, when leaving a cursor because of an exception.
+    """
+    db = pool.acquire(False)
+    with pytest.raises(sqlite3.InterfaceError):
+        with db.cursor() as sql:
+            sql.insert("INSERT INTO project VALUES (NULL, 1, 'TPR1', NULL)")
+            sql.insert("INSERT INTO project VALUES (NULL, 1, :code, NULL)", code=[1]) # can't bind a list
+    db.close()
+    db = pool.acquire(True)
+    with db.cursor() as sql:
+        assert sql.selectSingle("SELECT COUNT(*) FROM project") == 0
+    db.close()
+
+def test_reuse(pool):
+    """ Check released connections are reused, and the pool never exceeds its size.
+    """
+    def work(readonly):
+        for _ in xrange(20):
+            db = pool.acquire(readonly)
+            with db.cursor() as sql:
+                if readonly:
+                    sql.selectSingle("SELECT COUNT(*) FROM project")
+                else:
+                    sql.insert("INSERT INTO project VALUES (NULL, 1, NULL, NULL)")
+            db.close()
+    threads = [Thread(target=work, args=(i % 2 == 0,)) for i in xrange(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.to_dict()
+    assert stats['open'] <= 2
+    assert stats['acquired_ro'] == stats['acquired_rw'] == 60
+    assert stats['reused'] > 0
+    db = pool.acquire(True)
+    with db.cursor() as sql:
+        assert sql.selectSingle("SELECT COUNT(*) FROM project") == 60
+    db.close()
+
+def test_wait(tmpdir):
+    """ Check acquiring a connection from a full pool fails after the pool's wait, and succeeds
+        once one is released.
+    """
+    path = str(tmpdir.join('test.db'))
+    pool = SqlPool(path, 2, timeout=1.0, wait=0.1)
+    held = [pool.acquire(True), pool.acquire(False)]
+    start = time.time()
+    with pytest.raises(PoolTimeout):
+        pool.acquire(True)
+    assert 0.1 <= time.time() - start < 1.0
+    assert pool.to_dict()['wait_timeouts'] == 1
+    held.pop().close()
+    pool.acquire(True).close()
+    held.pop().close()
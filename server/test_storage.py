@@ -0,0 +1,122 @@
+""" Unit tests for the attachment storage module.
+"""
+import os
+import hashlib
+import pytest
+from sql import SqlDatabase
+import migrations
+from storage import BlobStore, FileStore, MissingBody
+
+@pytest.fixture()
+def db():
+    db = SqlDatabase(':memory:')
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    migrations.migrate(db)
+    return db
+
+def _read(store, db, attachment_id, start, stop):
+    with db.cursor() as sql:
+        hash = sql.selectSingle("SELECT hash FROM attachment WHERE attachment_id=:attachment_id", attachment_id=attachment_id)
+    return ''.join(store.read(db, attachment_id, hash, start, stop))
+
+def test_blob_store(db):
+    """ Check attachment bodies round trip through the database, including byte ranges.
+    """
+    store = BlobStore()
+    data = os.urandom(200000)
+    with db.cursor() as sql:
+        attachment_id = store.add(sql, 'a.bin', None, data)
+        assert sql.selectSingle("SELECT size FROM attachment") == len(data)
+    assert _read(store, db, attachment_id, 0, len(data)) == data
+    assert _read(store, db, attachment_id, 1000, 70000) == data[1000:70000]
+
+def test_file_store(db, tmpdir):
+    """ Check bodies are written to files, that BLOBs are migrated out, and that check()
+        and remove() behave.
+    """
+    with db.cursor() as sql:
+        old_id = BlobStore().add(sql, 'old.bin', None, 'old data')
+    store = FileStore(str(tmpdir))
+    with db.cursor() as sql:
+        new_id = store.add(sql, 'new.bin', None, 'new data')
+        assert sql.selectSingle("SELECT data FROM attachment WHERE attachment_id=:id", id=new_id) is None
+    assert os.path.exists(store.path(hashlib.md5('new data').hexdigest()))
+    assert _read(store, db, old_id, 0, 8) == 'old data' # not migrated yet
+    assert _read(store, db, new_id, 4, 8) == 'data'
+
+    assert store.migrate(db, batch=1) == 1
+    assert os.path.exists(store.path(hashlib.md5('old data').hexdigest()))
+    assert _read(store, db, old_id, 0, 8) == 'old data'
+    assert store.check(db) == []
+
+    with db.cursor() as sql:
+        hash = sql.selectSingle("SELECT hash FROM attachment WHERE attachment_id=:id", id=new_id)
+        sql.delete("DELETE FROM attachment WHERE attachment_id=:id", id=new_id)
+        store.remove(sql, hash)
+    assert not os.path.exists(store.path(hash))
+
+    stray = tmpdir.join('stray')
+    stray.write('x')
+    assert len(store.check(db)) == 1
+    assert len(store.check(db, prune=True)) == 1
+    assert store.check(db) == []
+
+def test_file_store_race(db, tmpdir):
+    """ Check a body's file is written after its attachment row is inserted (so, with the write
+        lock held, after any delete which removed the file has committed), and that a missing
+        body is reported before any data is read.
+    """
+    store = FileStore(str(tmpdir))
+    put = store._put # pylint: disable=protected-access
+    def check_put(hash, data):
+        with db.cursor() as sql:
+            assert sql.selectSingle("SELECT COUNT(*) FROM attachment WHERE hash=:hash", hash=hash) > 0
+        return put(hash, data)
+    store._put = check_put # pylint: disable=protected-access
+    with db.cursor() as sql:
+        old_id = store.add(sql, 'a.bin', None, 'data')
+        hash = sql.selectSingle("SELECT hash FROM attachment WHERE attachment_id=:id", id=old_id)
+        sql.delete("DELETE FROM attachment WHERE attachment_id=:id", id=old_id)
+        store.remove(sql, hash)
+        assert not os.path.exists(store.path(hash))
+        new_id = store.add(sql, 'a.bin', None, 'data')
+    assert _read(store, db, new_id, 0, 4) == 'data'
+
+    os.remove(store.path(hash))
+    with pytest.raises(MissingBody):
+        store.read(db, new_id, hash, 0, 4)
+
+def test_attachment_ranges(db, monkeypatch):
+    """ Check single byte ranges get a 206 (or a 416 if unsatisfiable), and that multiple ranges
+        and an If-Range not matching the ETag (including a date) get the full data.
+    """
+    import server # pylint: disable=import-error
+    store = BlobStore()
+    data = '0123456789'
+    with db.cursor() as sql:
+        attachment_id = store.add(sql, 'a.txt', None, data)
+        hash = sql.selectSingle("SELECT hash FROM attachment WHERE attachment_id=:id", id=attachment_id)
+
+    class Store(object):
+        def read(self, _, attachment_id, hash, start, stop):
+            return store.read(db, attachment_id, hash, start, stop)
+    monkeypatch.setattr(server.application, 'store', Store())
+
+    def get(**headers):
+        with server.application.test_request_context('/file/{0}'.format(attachment_id), headers=headers):
+            rsp = server.application.make_response(server._attachment_response(attachment_id, 'a.txt', hash, len(data))) # pylint: disable=protected-access
+            return rsp.status_code, ''.join(rsp.response)
+
+    assert get() == (200, data)
+    assert get(Range='bytes=2-4') == (206, '234')
+    assert get(Range='bytes=2-4', **{'If-Range': '"{0}"'.format(hash)}) == (206, '234')
+    assert get(Range='bytes=20-') == (416, 'Range not satisfiable')
+    assert get(Range='bytes=0-1,4-5') == (200, data)
+    assert get(Range='bytes=2-4', **{'If-Range': '"other"'}) == (200, data)
+    assert get(Range='bytes=2-4', **{'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == (200, data)
+
+    def missing(self, _, attachment_id, hash, start, stop): # pylint: disable=unused-argument
+        raise MissingBody(attachment_id)
+    monkeypatch.setattr(Store, 'read', missing)
+    assert get() == (500, 'Attachment data missing')
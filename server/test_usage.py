@@ -0,0 +1,55 @@
+""" Unit tests for the usage module.
+"""
+import pytest
+from sql import SqlDatabase
+import migrations
+import usage
+
+class Index(object):
+    """ Mock AssetIndex, faceting a list of documents.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def search(self, params):
+        field = dict(params)['facet.field']
+        counts = {}
+        for doc in self.docs:
+            if field in doc:
+                counts[str(doc[field])] = counts.get(str(doc[field]), 0) + 1
+        return {'facet_counts': {'facet_fields': {field: [x for c in sorted(counts.items()) for x in c]}}}
+
+@pytest.fixture()
+def db():
+    db = SqlDatabase(':memory:')
+    with db.cursor() as sql:
+        sql.executePath('../sql/create.sql')
+    migrations.migrate(db)
+    return db
+
+def test_usage(db):
+    """ Check usage counts are computed from SOLR when first needed, then follow asset writes
+        and merges, and that reconciling finds any drift.
+    """
+    docs = [{'id': '1', 'condition': 1, 'manufacturer': 7}, {'id': '2', 'condition': 1}, {'id': '3', 'condition': 2}]
+    index = Index(docs)
+    with db.cursor() as sql:
+        usage.update_usage(sql, None, {'id': '4', 'condition': 3}) # not maintained yet
+        assert usage.get_usage(sql, index, 'condition') == {'1': 2, '2': 1}
+        assert usage.reconciled_fields(sql) == set(['condition'])
+
+        docs.append({'id': '4', 'condition': '2', 'manufacturer': 7})
+        usage.update_usage(sql, None, docs[-1])
+        usage.update_usage(sql, docs[0], {'id': '1', 'manufacturer': 7}) # condition removed
+        usage.update_usage(sql, docs[1], {'condition': 3}, partial=True)
+        usage.update_usage(sql, docs[2], None) # deleted
+        assert usage.get_usage(sql, index, 'condition') == {'2': 1, '3': 1}
+
+        usage.merge_usage(sql, 'condition', 3, 2)
+        assert usage.get_usage(sql, index, 'condition') == {'2': 2}
+        usage.merge_usage(sql, 'manufacturer', 7, 8) # not maintained
+        assert usage.reconciled_fields(sql) == set(['condition'])
+
+        # the mock index still has the original documents, plus the added one
+        assert usage.reconcile(sql, index, 'condition') == [('1', 0, 2)]
+        assert usage.get_usage(sql, index, 'condition') == {'1': 2, '2': 2}
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+""" Usage counts of enum values in SOLR asset fields, held in the enum_usage table (see
+    migrations.py) so that checking which values are in use needs no facet query.
+
+    A field's counts are first computed from a SOLR facet when needed, and from then on kept up
+    to date as the server writes assets and merges values. Writes made elsewhere (imports,
+    scripts) are picked up when the counts are next reconciled against SOLR, which should be
+    done periodically. Project usage, being from bookings, is kept in project_booking_count.
+
+    Usage: usage.py <database> [field ...]
+"""
+import sys
+from sql import SqlDatabase
+from solr import AssetIndex
+from config import SOLR_COLLECTION
+
+RECONCILED_FIELDS_SQL = "SELECT field FROM enum_usage_field"
+
+USAGE_SQL = "SELECT value, n FROM enum_usage WHERE field=:field AND n > 0"
+
+ADD_USAGE_SQL = "INSERT OR IGNORE INTO enum_usage VALUES (:field, :value, 0)"
+
+CHANGE_USAGE_SQL = "UPDATE enum_usage SET n=n+:delta WHERE field=:field AND value=:value"
+
+MERGE_USAGE_SQL = """
+  UPDATE enum_usage
+     SET n=n+IFNULL((SELECT n FROM enum_usage WHERE field=:field AND value=:source), 0)
+   WHERE field=:field AND value=:target
+"""
+
+def reconciled_fields(sql):
+    """ Return the set of fields whose usage counts are maintained.
+    """
+    return set(sql.selectAllSingle(RECONCILED_FIELDS_SQL))
+
+def facet_counts(index, field):
+    """ Return a dictionary from value (as a string) to usage count for a field, from SOLR.
+    """
+    r = index.search([('q', '*'), ('rows', 0), ('facet', 'true'), ('facet.field', field), ('facet.limit', -1), ('facet.mincount', 1)])
+    facets = r['facet_counts']['facet_fields'][field]
+    return dict((str(value), n) for value, n in zip(facets[::2], facets[1::2]))
+
+def reconcile(sql, index, field):
+    """ Replace the usage counts for a field with those from SOLR, from then on maintaining them.
+        Returns a list of (value, stored count, actual count) for each count that was wrong.
+    """
+    stored = dict((str(value), n) for value, n in sql.selectAll(USAGE_SQL, field=field)) if field in reconciled_fields(sql) else {}
+    actual = facet_counts(index, field)
+    sql.delete("DELETE FROM enum_usage WHERE field=:field", field=field)
+    for value, n in actual.iteritems():
+        sql.insert("INSERT INTO enum_usage VALUES (:field, :value, :n)", field=field, value=value, n=n)
+    sql.insert("INSERT OR REPLACE INTO enum_usage_field VALUES (:field, datetime('now'))", field=field)
+    return [(value, stored.get(value, 0), actual.get(value, 0)) for value in sorted(set(stored) | set(actual)) if stored.get(value, 0) != actual.get(value, 0)]
+
+def get_usage(sql, index, field):
+    """ Return a dictionary from value (as a string) to usage count for a field, omitting unused
+        values. The counts are computed from SOLR the first time they are needed.
+    """
+    if field not in reconciled_fields(sql):
+        reconcile(sql, index, field)
+    return dict((str(value), n) for value, n in sql.selectAll(USAGE_SQL, field=field))
+
+def _values(doc, field):
+    values = doc.get(field) if doc is not None else None
+    if values is None:
+        return []
+    return [str(value) for value in (values if isinstance(values, list) else [values])]
+
+def update_usage(sql, old, new, partial=False):
+    """ Update the usage counts for an asset changing from the old to the new document (either
+        of which may be None, for an added or deleted asset). If partial is True, new holds only
+        the fields changed by an atomic update.
+    """
+    for field in reconciled_fields(sql):
+        if partial and field not in new:
+            continue
+        before, after = _values(old, field), _values(new, field)
+        for value in before:
+            if value not in after:
+                sql.update(CHANGE_USAGE_SQL, field=field, value=value, delta=-1)
+        for value in after:
+            if value not in before:
+                sql.insert(ADD_USAGE_SQL, field=field, value=value)
+                sql.update(CHANGE_USAGE_SQL, field=field, value=value, delta=1)
+
+def merge_usage(sql, field, source, target):
+    """ Move the usage count of the source value of a field to the target value.
+    """
+    if source != target and field in reconciled_fields(sql):
+        sql.insert(ADD_USAGE_SQL, field=field, value=target)
+        sql.update(MERGE_USAGE_SQL, field=field, source=source, target=target)
+        sql.delete("DELETE FROM enum_usage WHERE field=:field AND value=:source", field=field, source=source)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print >>sys.stderr, "Usage: {0} <database> [field ...]".format(sys.argv[0])
+        sys.exit(1)
+
+    db = SqlDatabase(sys.argv[1])
+    index = AssetIndex(SOLR_COLLECTION)
+    with db.cursor() as sql:
+        fields = sys.argv[2:] or sorted(reconciled_fields(sql))
+        for field in fields:
+            for value, stored, actual in reconcile(sql, index, field):
+                print "{0} {1}: had count {2}, SOLR has {3}".format(field, value, stored, actual)
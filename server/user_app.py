@@ -4,12 +4,13 @@
 import sys
 import os
 import functools
-from time import time
 from sql import NoResult
 from sql_app import SqlApplication, SqlDatabase, DATABASE
 from flask import request
 from flask_login import LoginManager, login_required, current_user, login_user, logout_user
-from config import ROUNDS, USER_TIMEOUT_SECS
+from sessions import SessionRegistry, SqlSessionRegistry
+from cache import ExpiringCache
+from config import ROUNDS, USER_TIMEOUT_SECS, SHARED_SESSIONS, SESSION_SYNC_SECS, SECRET_KEY, DATABASE_TIMEOUT, PRINCIPAL_TTL_SECS
 
 try:
     from hashlib import pbkdf2_hmac
@@ -18,10 +19,19 @@ except ImportError:
 
 ANONYMOUS, VIEW_ROLE, BOOK_ROLE, ADMIN_ROLE = range(4)
 
+ROLE_LABEL_SQL = "SELECT label FROM enum, enum_entry WHERE field='role' AND enum_entry.enum_id=enum.enum_id AND value=:role"
+
+PRINCIPAL_SQL = """
+  SELECT role, username, email, label, password_salt, password_hash,
+         (SELECT label FROM enum AS r, enum_entry AS re WHERE r.field='role' AND re.enum_id=r.enum_id AND re.value=role) AS role_label
+    FROM user, enum, enum_entry
+   WHERE user_id=:user_id AND field='user' AND enum.enum_id=enum_entry.enum_id AND value=user_id
+"""
+
 class User(object):
     """ User session class for flask login.
     """
-    def __init__(self, user_id, role, username, email, label, password_salt, password_hash):
+    def __init__(self, user_id, role, username, email, label, password_salt, password_hash, role_label=None):
         self.user_id = user_id
         self.role = role
         self.username = username
@@ -29,6 +39,7 @@ class User(object):
         self.label = label
         self.password_salt = str(password_salt)
         self.password_hash = str(password_hash)
+        self.role_label = role_label
         self.is_authenticated = True
         self.is_active = True
         self.is_anonymous = False	
@@ -52,16 +63,22 @@ class User(object):
     def to_dict(self, db):
         """ Return fields in a dictionary, omitting password fields.
         """
-        with db.cursor() as sql:
-            roleLabel = sql.selectSingle("SELECT label FROM enum, enum_entry WHERE field='role' AND enum_entry.enum_id=enum.enum_id AND value=:role", role=self.role)
+        roleLabel = self.role_label
+        if roleLabel is None:
+            with db.cursor() as sql:
+                roleLabel = sql.selectSingle(ROLE_LABEL_SQL, role=self.role)
         return {'user_id': self.user_id, 'role': self.role, 'username': self.username, 'email': self.email, 'label': self.label, 'roleLabel': roleLabel}
 
 class UserApplication(SqlApplication):
     def __init__(self, name, **args):
         super(UserApplication, self).__init__(name, **args)
-        self.secret_key = os.urandom(32)
-        self.request_times = {}
-        self.logged_in_users = []
+        self.secret_key = SECRET_KEY or os.urandom(32)
+        if SHARED_SESSIONS:
+            self.logged_in_users = SqlSessionRegistry(USER_TIMEOUT_SECS, DATABASE, SESSION_SYNC_SECS, DATABASE_TIMEOUT)
+        else:
+            self.logged_in_users = SessionRegistry(USER_TIMEOUT_SECS)
+        # user details by user id, including the role label, so that requests needn't look them up
+        self.principals = ExpiringCache(PRINCIPAL_TTL_SECS)
         self.before_request(self.check_user_timeout)
         login_manager = LoginManager()
         login_manager.init_app(self)
@@ -72,11 +89,14 @@ class UserApplication(SqlApplication):
         """
         if user_id not in self.logged_in_users:
             return None # log out this user, who was logged in before server restart
-        try:
-            with self.db.cursor() as sql:
-                values = sql.selectOne("SELECT role, username, email, label, password_salt, password_hash FROM user, enum, enum_entry WHERE user_id=:user_id AND field='user' AND enum.enum_id=enum_entry.enum_id AND value=user_id", user_id=user_id)
-        except NoResult:
-            return None
+        values = self.principals.get(user_id)
+        if values is None:
+            try:
+                with self.db.cursor() as sql:
+                    values = sql.selectOne(PRINCIPAL_SQL, user_id=user_id)
+            except NoResult:
+                return None
+            self.principals.put(user_id, values)
         return User(user_id, *values)
 
     def user_has_role(self, roles): # pylint: disable=no-self-use
@@ -90,8 +110,6 @@ class UserApplication(SqlApplication):
         def _role_decorator(func):
             @functools.wraps(func)
             def _decorated_view(*args, **kwargs):
-                if hasattr(current_user, 'name'):
-                    self.request_times[current_user.name] = time()
                 if self.user_has_role(roles):
                     return login_required(func)(*args, **kwargs)
                 return "Need required role", 403
@@ -99,20 +117,21 @@ class UserApplication(SqlApplication):
         return _role_decorator
 
     def check_user_timeout(self):
-        """ Check for user timeout since last request.
+        """ Check for user timeout since last request, and restart the current user's timeout.
         """
+        if not self.migrated:
+            self._migrate() # before the session registry is used, as it may be in the database
         if USER_TIMEOUT_SECS is None:
             return None
         # check for user timeouts
-        for user_id in self.logged_in_users:
-            if not self.debug and time() > self.request_times[user_id] + USER_TIMEOUT_SECS:
-                self.logged_in_users.remove(user_id)
+        self.logged_in_users.expire()
         # check whether current user has been logged out?
         if not hasattr(current_user, 'role'):
             return None
         if current_user.user_id not in self.logged_in_users:
             logout_user()
             return "User session timed out", 403
+        self.logged_in_users.touch(current_user.user_id)
         return None
 
     def login(self, username, password):
@@ -124,8 +143,7 @@ class UserApplication(SqlApplication):
                 user = User(*values)
                 if user.check_password(password):
                     login_user(user)
-                    self.request_times[user.user_id] = time()
-                    self.logged_in_users.append(user.user_id)
+                    self.logged_in_users.add(user.user_id)
                     sql.update("UPDATE user SET last_login=date('now') WHERE user_id=:user_id", user_id=user.user_id)
                     return user
         except NoResult:
@@ -136,7 +154,7 @@ class UserApplication(SqlApplication):
         """ Logout the current user. Does nothing if not logged in.
         """
         user_id = getattr(current_user, 'user_id', None)
-        if user_id is not None and user_id in self.logged_in_users:
+        if user_id is not None:
             self.logged_in_users.remove(user_id)
         logout_user()
 
@@ -155,6 +173,7 @@ class UserApplication(SqlApplication):
                 user_dict = current_user.to_dict(self.db)
             sql.update("UPDATE user SET email=:email WHERE user_id=:user_id", user_dict)
             sql.update("UPDATE enum_entry SET label=:label WHERE enum_id=(SELECT enum_id FROM enum WHERE field='user') AND value=:user_id", user_dict)
+        self.principals.invalidate(current_user.user_id)
 
     def add_user(self, user_dict):
         """ Add a new user with values from the given user dictionary. Returns whether a new user
@@ -190,7 +209,8 @@ class UserApplication(SqlApplication):
             if sql.update(stmt, user_dict, salt=buffer(user.password_salt), hash=buffer(user.password_hash), user_id=user_id) == 0:
                 return None
             sql.update("UPDATE enum_entry SET label=:label WHERE enum_id=(SELECT enum_id FROM enum WHERE field='user') AND value=:user_id", user_dict, user_id=user_id)
-            return user_id
+        self.principals.invalidate(int(user_id)) # the user id may be from a URL
+        return user_id
 
     def delete_user(self, user_id):
         """ Delete the user with given user id. A user can not delete themselves.
@@ -200,7 +220,9 @@ class UserApplication(SqlApplication):
             if ok:
                 enum_id = sql.selectSingle("SELECT enum_id FROM enum WHERE field=:field", field='user')
                 sql.delete("DELETE FROM enum_entry WHERE enum_id=:enum_id AND value=:value", enum_id=enum_id, value=user_id)
-            return ok
+        if ok:
+            self.principals.invalidate(int(user_id)) # the user id may be from a URL
+        return ok
 
 if __name__ == '__main__':
     if len(sys.argv) != 5:
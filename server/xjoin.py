@@ -5,16 +5,76 @@ import sys
 import os
 from time import time
 import functools
+from itertools import islice
 import requests
 from sql import SqlDatabase, NoResult
 import mimetypes
 from werkzeug.local import LocalProxy
-from flask import Flask, redirect, request, Response, send_file, g
+from flask import Flask, redirect, request, Response, send_file, g, stream_with_context
 from user_app import UserApplication, ADMIN_ROLE, BOOK_ROLE, VIEW_ROLE
 from sql_app import SqlApplication
+from enums import EnumRegistry
+from cache import ResultCache
+from config import XJOIN_CACHE_SIZE, XJOIN_CACHE_IDS
 
 application = SqlApplication(__name__, static_path=None) # pylint: disable=invalid-name
+application.enums = EnumRegistry()
+application.cache = ResultCache(XJOIN_CACHE_SIZE)
 
+# results depend only on the bookings and today's date
+BOOKING_VERSION_SQL = "SELECT version, date('now') FROM version WHERE name='booking'"
+
+IDS_CHUNK = 1000 # asset ids per chunk of streamed output
+
+OUT_SQL = "SELECT asset_id FROM booking WHERE out_date IS NOT NULL AND in_date IS NULL"
+DUE_OUT_SQL = "SELECT asset_id FROM booking WHERE out_date IS NULL AND due_out_date <= date('now') AND date('now') <= due_in_date"
+OVERDUE_SQL = "SELECT asset_id FROM booking WHERE out_date IS NOT NULL AND in_date IS NULL AND due_in_date < date('now')"
+UNAVAILABLE_SQL = "SELECT asset_id FROM booking WHERE due_out_date <= :date AND :date <= due_in_date AND in_date IS NULL"
+
+EXTANT_CLAUSE = "(date('now') <= due_in_date OR (out_date IS NOT NULL AND in_date IS NULL))"
+FILTER_PROJECT_SQL = "SELECT DISTINCT(asset_id) FROM booking WHERE project=:project_id AND {0}".format(EXTANT_CLAUSE)
+FILTER_USER_SQL = "SELECT DISTINCT(asset_id) FROM booking WHERE user_id=:user_id AND {0}".format(EXTANT_CLAUSE)
+
+def _select(sql, stmt, **values):
+    """ Return the JSON for the asset ids selected by the statement, from the cache if the
+        bookings and date have not changed.
+    """
+    version, today = sql.selectOne(BOOKING_VERSION_SQL)
+    key = (stmt, tuple(sorted(values.iteritems())))
+    return application.cache.get(key, (version, today), lambda: json.dumps(sql.selectAllDict(stmt, values)))
+
+def _stream_ids(sql, stmt, **values):
+    """ Return a response streaming a flat JSON array of the asset ids selected by the statement,
+        straight from the SQL cursor, or from the cache if the bookings and date have not changed.
+        The (compact) output is cached once streamed, unless it has more than XJOIN_CACHE_IDS ids,
+        in which case the chunks are not kept.
+    """
+    version = tuple(sql.selectOne(BOOKING_VERSION_SQL))
+    key = ('ids', stmt, tuple(sorted(values.iteritems())))
+    body = application.cache.lookup(key, version)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+
+    def generate():
+        chunks = [] # kept for the cache, unless there turn out to be too many ids
+        count = 0
+        with application.db.cursor() as sql:
+            rows = sql.selectIterSingle(stmt, values)
+            while True:
+                ids = [str(asset_id) for asset_id in islice(rows, IDS_CHUNK)]
+                if len(ids) == 0:
+                    break
+                chunk = ','.join(ids)
+                yield ('[' if count == 0 else ',') + chunk
+                count += len(ids)
+                if count <= XJOIN_CACHE_IDS:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+        yield ']' if count > 0 else '[]'
+        if chunks is not None:
+            application.cache.put(key, version, '[' + ','.join(chunks) + ']')
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @application.route('/')
 def main_endpoint():
@@ -22,50 +82,62 @@ def main_endpoint():
     """
     return json.dumps({'name': 'BADASS XJoin (SOLR) API'})
 
+@application.route('/stats')
+def stats_endpoint():
+    """ Output result cache and SQL statistics.
+    """
+    return json.dumps({'cache': application.cache.stats(), 'sql': application.sql_stats()})
+
 @application.route('/enum')
 def enums_endpoint():
     """ Endpoint for getting enumerations.
     """
     with application.db.cursor() as sql:
-        enums = {}
-        for enum_id, field in sql.selectAll("SELECT enum_id, field FROM enum"):
-            stmt = "SELECT value, label, `order` FROM enum_entry WHERE enum_id=:enum_id"
-            enums[field] = sql.selectAllDict(stmt, enum_id=enum_id)
-        return json.dumps(enums)
-
-@application.route('/booking')
-def booking_endpoint():
-    """ Booking XJoin endpoint.
+        enums, _, etag = application.enums.load(sql)
+    if etag in request.if_none_match:
+        rsp = Response(status=304) # Solr already has these enums
+    else:
+        rsp = Response(json.dumps(enums), mimetype='application/json')
+    rsp.set_etag(etag)
+    return rsp
+
+@application.route('/booking', defaults={'ids': False})
+@application.route('/booking/ids', defaults={'ids': True})
+def booking_endpoint(ids):
+    """ Booking XJoin endpoint. The /ids variant outputs a flat array of asset ids, rather than
+        an array of {"asset_id": id} objects.
     """
+    select = _stream_ids if ids else _select
     with application.db.cursor() as sql:
         if 'out' in request.args:
             # all assets that are currently out
-            return json.dumps(sql.selectAllDict("SELECT asset_id FROM booking WHERE out_date IS NOT NULL AND in_date IS NULL"))
+            return select(sql, OUT_SQL)
         elif 'due' in request.args:
             if request.args['due'] == 'out':
                 # all assets that are due out (so today is after the due_out_date but before the due_in_date)
-                return json.dumps(sql.selectAllDict("SELECT asset_id FROM booking WHERE out_date IS NULL AND due_out_date <= date('now') AND date('now') <= due_in_date"))
+                return select(sql, DUE_OUT_SQL)
             elif request.args['due'] == 'in':
                 # all assets that are currently overdue to be returned
-                return json.dumps(sql.selectAllDict("SELECT asset_id FROM booking WHERE out_date IS NOT NULL AND in_date IS NULL AND due_in_date < date('now')"))
+                return select(sql, OVERDUE_SQL)
         elif 'unavailable' in request.args:
             # all assets that are NOT available (so not due in and not returned early) on the specified date (we use this negatively)
-            return json.dumps(sql.selectAllDict("SELECT asset_id FROM booking WHERE due_out_date <= '{0}' AND '{0}' <= due_in_date AND in_date IS NULL".format(request.args['unavailable'])))
+            return select(sql, UNAVAILABLE_SQL, date=request.args['unavailable'])
     return "Unknown booking arguments", 400
 
 
-@application.route('/filter')
-def project_endpoint():
-    """ Filter XJoin endpoint.
+@application.route('/filter', defaults={'ids': False})
+@application.route('/filter/ids', defaults={'ids': True})
+def project_endpoint(ids):
+    """ Filter XJoin endpoint, with an /ids variant as for the booking endpoint.
     """
-    EXTANT_CLAUSE = "(date('now') <= due_in_date OR (out_date IS NOT NULL AND in_date IS NULL))"
+    select = _stream_ids if ids else _select
     with application.db.cursor() as sql:
         if 'project' in request.args:
             # booking data for XJoin (filters for assets based on project)
-            return json.dumps(sql.selectAllDict("SELECT DISTINCT(asset_id) FROM booking WHERE project=:project_id AND {0}".format(EXTANT_CLAUSE), project_id=request.args['project']))
+            return select(sql, FILTER_PROJECT_SQL, project_id=request.args['project'])
         if 'user' in request.args:
             # booking data for XJoin (filters for assets based on user)
-            return json.dumps(sql.selectAllDict("SELECT DISTINCT(asset_id) FROM booking WHERE user_id=:user_id AND {0}".format(EXTANT_CLAUSE), user_id=request.args['user']))
+            return select(sql, FILTER_USER_SQL, user_id=request.args['user'])
     return "Unknown filter arguments", 400
 
 
@@ -2,6 +2,7 @@ package uk.org.ofcom.ses.bams.solr;
 
 import java.io.IOException;
 import java.io.InputStreamReader;
+import java.net.HttpURLConnection;
 import java.net.MalformedURLException;
 import java.net.URL;
 import java.util.HashMap;
@@ -50,23 +51,36 @@ public class EnumValueSourceParser extends ValueSourceParser {
 	// reload count - this is a query cache buster
 	private int count;
 
+	// ETag of the enums last loaded, so that unchanged enums are not transferred again
+	private String etag;
+
 	private Map<String, Map<String, Long>> loadEnums() {
-		try (InputStreamReader in = new InputStreamReader(enumsUrl.openStream())) {
-			Map<String, Map<String, Long>> enumValues = new HashMap<>();
-			JSONParser parser = new JSONParser();
-			JSONObject enums = (JSONObject)parser.parse(in);
-			for (Object field : enums.keySet()) {
-				Map<String, Long> values = new HashMap<String, Long>();
-				enumValues.put((String)field, values);
-				JSONArray mappings = (JSONArray)enums.get(field);
-				for (int i = 0; i < mappings.size(); ++i) {
-					JSONObject mapping = (JSONObject)mappings.get(i);
-					String value = mapping.get("value").toString();
-					Long order = (Long)mapping.get("order");
-					values.put(value, order);
+		try {
+			HttpURLConnection connection = (HttpURLConnection)enumsUrl.openConnection();
+			if (etag != null) {
+				connection.setRequestProperty("If-None-Match", etag);
+			}
+			if (connection.getResponseCode() == HttpURLConnection.HTTP_NOT_MODIFIED) {
+				return enumValues;
+			}
+			try (InputStreamReader in = new InputStreamReader(connection.getInputStream())) {
+				Map<String, Map<String, Long>> enumValues = new HashMap<>();
+				JSONParser parser = new JSONParser();
+				JSONObject enums = (JSONObject)parser.parse(in);
+				for (Object field : enums.keySet()) {
+					Map<String, Long> values = new HashMap<String, Long>();
+					enumValues.put((String)field, values);
+					JSONArray mappings = (JSONArray)enums.get(field);
+					for (int i = 0; i < mappings.size(); ++i) {
+						JSONObject mapping = (JSONObject)mappings.get(i);
+						String value = mapping.get("value").toString();
+						Long order = (Long)mapping.get("order");
+						values.put(value, order);
+					}
 				}
+				etag = connection.getHeaderField("ETag");
+				return enumValues;
 			}
-			return enumValues;
 		} catch (IOException | ParseException e) {
 			throw new RuntimeException(e);
 		} finally {
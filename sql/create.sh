@@ -1,3 +1,4 @@
 rm $1 
 cat create.sql | sqlite3 $1
+python ../server/migrations.py $1
 echo .tables | sqlite3 $1
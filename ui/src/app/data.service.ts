@@ -17,6 +17,7 @@ declare var $;
 @Injectable()
 export class DataService {
   private base_url: string;
+  private enumsEtag: string; // version of the enums last received from search
 
   constructor(private http: Http) {
     this.base_url = window.location.protocol + '//' + window.location.hostname + ":3389";
@@ -113,6 +114,10 @@ export class DataService {
       params.set('reload_enums', 'true');
       search.reload_enums = false;
     }
+    if (this.enumsEtag) {
+      // the server omits the enums if they haven't changed
+      params.set('enums_etag', this.enumsEtag);
+    }
 
     let input = search.order.asc || search.order.desc;
     if (input) {
@@ -167,6 +172,7 @@ export class DataService {
     return this.get(`search${path}`, {search: params})
                .map(res => {
                  let json = res.json();
+                 this.enumsEtag = json.enums_etag;
                  let solr = json['solr'];
                  let start = solr.response.start;
                  let total = solr.response.numFound;